@@ -2,108 +2,180 @@ import streamlit as st
 import pandas as pd
 import random
 import os
+import time
+import numpy as np
 from datetime import datetime
-from openpyxl import load_workbook
+
+import bank
+import banks
+import grading
+import perf
+import quiz
+import reports
+import review
+import sessions
+from resources import (
+    BANK_DIR, EXCEL_PATH, SHEET_NAME, WRONG_LOG, STATS_LOG, ROLLUP_DB, SESSION_DB, cache_key, load_bank_registry, load_data,
+    load_error, load_index, get_edit_overlay, load_duplicates, load_search_index, get_wrong_log, load_wrong_index, get_rollups,
+    get_stats_writer, get_quiz_sessions
+)
 
 st.set_page_config(page_title="TIMS行銷專業能力認證 2025(初級)題庫", layout="wide")
+rerun_span = perf.span("rerun") # Whole-script timing; stopped at the end of the script
 st.title("TIMS行銷專業能力認證 2025(初級)題庫")
 
-# 檔案路徑設定
-EXCEL_PATH = "行銷題庫總表.xlsx"
-SHEET_NAME = "題庫總表"
-WRONG_LOG = "錯題紀錄.csv"
-STATS_LOG = "答題統計.csv" # 答題統計功能未在原碼中實現，但路徑已定義
+# 檔案路徑設定 (題庫目錄與各題庫資料檔名見 resources.py)
+LEGACY_WRONG_LOG = "錯題紀錄.csv" # 舊版 CSV 錯題紀錄，可由管理者匯入
+REPORTS_ZIP = "個人報表.zip" # 每位使用者的錯題與章節成績，產生於 .cache 目錄
 EDIT_PASSWORD = "quiz2024"
-
-# 使用st.cache_data載入資料，避免每次重跑都重新載入
-@st.cache_data
-def load_data():
-    """Loads the question data from the Excel file."""
-    try:
-        return pd.read_excel(EXCEL_PATH, sheet_name=SHEET_NAME)
-    except FileNotFoundError:
-        st.error(f"錯誤：找不到題庫檔案 `{EXCEL_PATH}`。請確認檔案是否存在。")
-        return pd.DataFrame() # Return empty dataframe on error
-    except Exception as e:
-        st.error(f"載入題庫時發生錯誤：{e}")
-        return pd.DataFrame()
-
-df = load_data()
-
-
-# 章節對應關係 (CH10 已移除)
-chapter_mapping = {f"CH{i}": [f"{i}-1", f"{i}-2"] for i in range(1, 10)}
+PERF_METRICS_PATH = "效能指標.prom" # Prometheus 文字格式指標，每分鐘最多寫出一次
+
+
+# 題庫清單與以下各快取 (題庫、索引、錯題紀錄、答題統計寫入器) 定義於 resources.py，由所有 session 共用
+bank_sources = {source.id: source for source in load_bank_registry(banks.directory_signature(BANK_DIR))}
+if not bank_sources:
+    # No bank found: keep the default so the loader reports the missing file
+    default_source = banks.BankSource(EXCEL_PATH, SHEET_NAME, os.path.splitext(EXCEL_PATH)[0], is_default=True)
+    bank_sources = {default_source.id: default_source}
+
+
+def reset_quiz():
+    """Ends the current quiz and drops the chapter selection when another bank is selected."""
+    st.session_state.quiz_started = False
+    if st.session_state.get("quiz_key"):
+        # Parked on disk, so the quiz can be resumed when the user comes back to its bank
+        quiz_sessions.spill(st.session_state.quiz_key)
+    st.session_state.quiz_key = None
+    st.session_state.pop("resume_checked", None)
+    st.session_state.pop("chapters_select", None) # The chapters of the new bank may differ
+
+
+# 每個 session 各自選擇題庫；題庫於第一次被選用時才載入
+if st.session_state.get("bank_id") not in bank_sources:
+    st.session_state.bank_id = next(iter(bank_sources))
+st.sidebar.selectbox("📚 選擇題庫", list(bank_sources), format_func=lambda bank_id: bank_sources[bank_id].label,
+                     key="bank_id", on_change=reset_quiz)
+current_bank = bank_sources[st.session_state.bank_id]
+
+
+# 目前題庫及其索引 (serve.py 啟動時預先載入預設題庫，第一位使用者不需等待)
+bank_key = cache_key(current_bank)
+df = perf.cached_call("load_data", load_data, *bank_key)
+bank_error = load_error(*bank_key)
+if bank_error:
+    st.error(bank_error) # Shown once, however many cached loaders read the failed bank
+bank_index = perf.cached_call("load_index", load_index, *bank_key)
+chapter_mapping = bank_index.chapter_map
+edit_overlay = get_edit_overlay(current_bank.excel_path, current_bank.sheet_name)
+if not df.empty:
+    # Apply pending edits (from this or another worker) to the shared bank; a no-op when nothing changed
+    edit_overlay.sync(df, bank_index)
+duplicate_index = perf.cached_call("load_duplicates", load_duplicates, *bank_key)
+
+# 目前題庫的錯題紀錄、答題彙總與答題統計寫入器
+wrong_store = get_wrong_log(current_bank.data_path(WRONG_LOG))
+wrong_index = perf.cached_call("load_wrong_index", load_wrong_index, *bank_key, current_bank.data_path(WRONG_LOG))
+stats_path = current_bank.data_path(STATS_LOG)
+rollup_store = get_rollups(current_bank.data_path(ROLLUP_DB), stats_path)
+stats_writer = get_stats_writer(stats_path, current_bank.data_path(ROLLUP_DB))
+# 作答進度 (所有題庫共用)：session 只保留鍵，測驗狀態由共用儲存管理，閒置時寫出到磁碟
+quiz_sessions = get_quiz_sessions(SESSION_DB)
 
 
 # 初始化 Session State
-for key in ["quiz_started", "questions", "user_answers", "shuffled_options", "last_settings", "is_admin_mode"]:
+session_defaults = {
+    "quiz_started": False,
+    "quiz_key": None, # This session's own key (sessions.new_quiz_key) of its quiz; the QuizState and settings live in quiz_sessions
+    "quiz_page": 0, # Current page in paged mode
+    "is_admin_mode": False, # Default is not in admin mode
+    "grading": None, # (uploaded file id, grading.GradeResult) of the last graded answer sheets
+    "answer_clock": time.time(), # Time of the quiz start or of the last answer, used to measure time-to-answer
+}
+for key, default in session_defaults.items():
     if key not in st.session_state:
-        # Default is not in admin mode
-        st.session_state[key] = False if key == "is_admin_mode" or key == "quiz_started" else [] if key.endswith("s") else None
+        st.session_state[key] = default
 
 
 # --- Helper function to generate quiz questions ---
-def generate_quiz_questions(username, mode, selected_chapters, num_questions, dataframe, chapter_map, wrong_log_path):
-    """Generates a list of questions based on the selected mode and settings."""
+def generate_quiz_questions(username, mode, selected_chapters, num_questions, dataframe, chapter_map, wrong_questions, index, seed=None,
+                            duplicate_clusters=None):
+    """Generates the bank row ids of a quiz based on the selected mode and settings.
+
+    With duplicate_clusters (a duplicates.DuplicateIndex), at most one question of each near-duplicate cluster is drawn.
+    """
     if dataframe.empty:
          st.warning("題庫資料為空，無法產生題目。")
-         return pd.DataFrame()
+         return bank.EMPTY_ROWS
+
+    rng = np.random.default_rng(seed)
+    sample_rows = duplicate_clusters.sample_rows if duplicate_clusters is not None else bank.sample_rows
 
     if mode == "一般出題模式":
-        sections = [s for ch in selected_chapters for s in chapter_map.get(ch, [])] # Use .get to handle potential missing keys
-        filtered = dataframe[dataframe["章節"].astype(str).isin(sections)]
-        if filtered.empty:
+        # Sample row positions from the prebuilt chapter index
+        rows = sample_rows(index.chapter_rows(selected_chapters), num_questions, rng)
+        if len(rows) == 0:
              st.warning(f"找不到符合所選章節 ({', '.join(selected_chapters)}) 的題目。")
-             return pd.DataFrame()
+        return rows
 
     elif mode == "錯題再練模式":
-        if os.path.exists(wrong_log_path):
-            try:
-                log = pd.read_csv(wrong_log_path)
-                # Filter log for the current user and chapters (if chapters selected)
-                user_wrong_log = log[log["使用者"].str.lower() == username.lower()]
-
-                # Apply chapter filter if selected_chapters is not empty
-                if selected_chapters:
-                    sections = [s for ch in selected_chapters for s in chapter_map.get(ch, [])]
-                    user_wrong_log = user_wrong_log[user_wrong_log["章節"].astype(str).isin(sections)]
-
-                if user_wrong_log.empty:
-                     st.info(f"使用者 `{username}` 沒有錯題紀錄，或所選章節 ({', '.join(selected_chapters)}) 中沒有錯題。")
-                     return pd.DataFrame()
-
-                # Merge with the main dataframe to get full question details
-                filtered = dataframe.merge(
-                    user_wrong_log[["章節", "題號"]].drop_duplicates(), # Use drop_duplicates in case a question is in the log multiple times
-                    on=["章節", "題號"]
-                )
-                if filtered.empty:
-                     st.warning(f"根據錯題紀錄，找不到對應的題目。")
-                     return pd.DataFrame() # Should not happen if user_wrong_log is not empty and merge keys are correct
-
-            except pd.errors.EmptyDataError:
-                 st.info("錯題紀錄檔案為空。")
-                 return pd.DataFrame()
-            except FileNotFoundError:
-                 st.info("找不到錯題紀錄檔案。請先進行作答以產生紀錄。")
-                 return pd.DataFrame()
-            except Exception as e:
-                 st.error(f"讀取錯題紀錄時發生錯誤：{e}")
-                 return pd.DataFrame()
-
-        else:
-            st.info("找不到錯題紀錄檔案。請先進行作答以產生紀錄。")
-            return pd.DataFrame()
+        try:
+            # This user's active wrong rows from the in-memory index, limited to the selected chapters if any,
+            # in spaced-repetition order: due questions first, weighted by how overdue and how hard they are
+            sections = [s for ch in selected_chapters for s in chapter_map.get(ch, [])] if selected_chapters else None
+            # Questions quarantined since they were logged are left out
+            wrong_rows = index.valid_rows(wrong_questions.drill_rows(username, sections, rng))
+        except Exception as e:
+             st.error(f"讀取錯題紀錄時發生錯誤：{e}")
+             return bank.EMPTY_ROWS
+
+        if not len(wrong_rows):
+             st.info(f"使用者 `{username}` 沒有錯題紀錄，或所選章節 ({', '.join(selected_chapters)}) 中沒有錯題。")
+             return bank.EMPTY_ROWS
+        if duplicate_clusters is not None:
+            wrong_rows = duplicate_clusters.first_distinct(wrong_rows)
+        return wrong_rows[:num_questions]
 
     else: # Should not happen with the new structure
         st.error("內部錯誤：無效的測驗模式選擇。")
-        return pd.DataFrame()
-
-    # Sample questions
-    if not filtered.empty:
-        return filtered.sample(n=min(num_questions, len(filtered))).reset_index(drop=True)
-    else:
-        return pd.DataFrame()
+        return bank.EMPTY_ROWS
+
+
+def change_quiz_page(step):
+    """Moves the paged quiz view by step pages."""
+    st.session_state.quiz_page += step
+
+
+def start_new_quiz(settings):
+    """Generates questions for the settings and resets the progress of the current quiz."""
+    # One seed drives both the sampling and the option order of every question
+    seed = random.getrandbits(63)
+    generate_span = perf.span("generate_quiz_questions")
+    rows = generate_quiz_questions(
+        settings["username"],
+        settings["mode"],
+        settings["selected_chapters"],
+        settings["num_questions"],
+        df,
+        chapter_mapping,
+        wrong_index,
+        bank_index,
+        seed,
+        duplicate_index if settings["avoid_duplicates"] else None
+    )
+    # The quiz keeps only row ids and the seed; question text is read from the shared bank
+    generate_span.stop()
+    st.session_state.answer_clock = time.time()
+    st.session_state.quiz_page = 0
+    # If no questions were generated, reset quiz_started (the warning is shown inside generate_quiz_questions)
+    st.session_state.quiz_started = len(rows) > 0
+    if st.session_state.quiz_started:
+        if st.session_state.quiz_key:
+            quiz_sessions.discard(st.session_state.quiz_key) # Replaced by the new quiz of this session
+        # A new key per quiz: other sessions of the same user never see or replace it while it is live
+        st.session_state.quiz_key = sessions.new_quiz_key()
+        resume_key = sessions.resume_key(current_bank.id, settings["username"])
+        quiz_sessions.put(st.session_state.quiz_key, resume_key, quiz.QuizState(rows, seed, df, drill=settings["mode"] == "錯題再練模式"), settings)
+        st.session_state.resume_checked = resume_key
 
 
 # --- Sidebar ---
@@ -114,8 +186,14 @@ st.session_state.username = st.sidebar.text_input("請輸入使用者名稱", va
 # --- Sidebar - Quiz Settings (Only display if not in admin mode) ---
 if not st.session_state.is_admin_mode:
     quiz_mode = st.sidebar.radio("選擇模式：", ["一般出題模式", "錯題再練模式"], key="quiz_mode_radio") # Removed "管理者登入"
-    selected_chapters = st.sidebar.multiselect("選擇章節：", list(chapter_mapping.keys()), default=["CH1"], key="chapters_select")
+    if quiz_mode == "錯題再練模式" and st.session_state.username.strip():
+        due_count, active_count = wrong_index.summary(st.session_state.username)
+        st.sidebar.caption(f"待複習 {due_count} 題 / 錯題 {active_count} 題 (連續答對 {review.RETIRE_STREAK} 次後自動移出)")
+    selected_chapters = st.sidebar.multiselect("選擇章節：", list(chapter_mapping.keys()), default=list(chapter_mapping)[:1], key="chapters_select")
     num_questions = st.sidebar.number_input("出題數量", min_value=1, max_value=50, value=5, key="num_questions_input")
+    # 分頁作答：每次只顯示部分題目，減少每次重跑要繪製的元件
+    page_size_option = st.sidebar.selectbox("每頁題數", ["全部", 1, 5, 10], key="page_size_select")
+    avoid_duplicates = st.sidebar.checkbox("避免相似題目出現在同一次測驗", value=True, key="avoid_duplicates_checkbox")
 
     # Start Quiz Button
     if st.sidebar.button("🚀 開始出題", key="start_quiz_button"):
@@ -124,33 +202,37 @@ if not st.session_state.is_admin_mode:
         elif df.empty:
              st.sidebar.warning("題庫資料為空，無法開始測驗。")
         else:
-            st.session_state.quiz_started = True
-            st.session_state.user_answers = [] # Reset answers for new quiz
-            st.session_state.shuffled_options = {} # Reset shuffled options
-
-            # Store current settings in session state for restarting
-            st.session_state.last_settings = {
+            # The settings are stored with the quiz for restarting
+            settings = {
                 "username": st.session_state.username,
                 "mode": quiz_mode, # Use quiz_mode selected in sidebar
                 "selected_chapters": selected_chapters,
-                "num_questions": num_questions
+                "num_questions": num_questions,
+                "avoid_duplicates": avoid_duplicates
             }
 
             # Generate questions
-            st.session_state.questions = generate_quiz_questions(
-                st.session_state.last_settings["username"],
-                st.session_state.last_settings["mode"],
-                st.session_state.last_settings["selected_chapters"],
-                st.session_state.last_settings["num_questions"],
-                df,
-                chapter_mapping,
-                WRONG_LOG
-            )
-
-            # If no questions were generated, reset quiz_started
-            if st.session_state.questions.empty:
-                 st.session_state.quiz_started = False
-                 # Warning is already shown inside generate_quiz_questions
+            start_new_quiz(settings)
+
+    # 還原未完成的測驗：開新分頁或伺服器重啟後，依使用者名稱接手已寫出到磁碟的測驗 (每個題庫與使用者檢查一次)
+    # Only spilled quizzes are taken over; a quiz held in memory belongs to a live session
+    resume_key = sessions.resume_key(current_bank.id, st.session_state.username) if st.session_state.username.strip() else None
+    if resume_key is not None and not st.session_state.quiz_started and st.session_state.get("resume_checked") != resume_key:
+        st.session_state.resume_checked = resume_key
+        quiz_key = sessions.new_quiz_key()
+        saved = quiz_sessions.claim(quiz_key, resume_key)
+        if saved is not None and not saved.state.matches(df):
+            quiz_sessions.discard(quiz_key) # Drawn from an earlier version of the bank
+            saved = None
+        if saved is not None:
+            saved.state.checked_key = bank_key
+            if st.session_state.quiz_key:
+                quiz_sessions.discard(st.session_state.quiz_key) # This session's finished quiz
+            st.session_state.quiz_key = quiz_key
+            st.session_state.quiz_started = True
+            st.session_state.quiz_page = 0
+            st.session_state.answer_clock = time.time()
+            st.sidebar.info(f"已還原未完成的測驗 (已回答 {saved.state.answered_count} / {len(saved.state.rows)} 題)")
 
 # --- Sidebar - Admin Mode Switch (Placed below the quiz settings/start button in sidebar) ---
 st.sidebar.markdown("---") # Separator
@@ -166,7 +248,7 @@ if st.session_state.is_admin_mode:
 
     if admin_pwd == EDIT_PASSWORD:
         st.header("📋 管理功能")
-        tool = st.radio("請選擇功能", ["題庫編輯", "錯題紀錄管理", "下載統計"], key="admin_tool_radio")
+        tool = st.radio("請選擇功能", ["題庫編輯", "題庫檢查", "錯題紀錄管理", "批次閱卷", "學習分析", "下載統計", "效能監控"], key="admin_tool_radio")
 
         if tool == "題庫編輯":
             st.subheader("✏️ 編輯題目")
@@ -174,15 +256,16 @@ if st.session_state.is_admin_mode:
                  st.warning("題庫資料為空，無法編輯題目。")
             else:
                 keyword = st.text_input("搜尋關鍵字", key="edit_keyword")
-                result = df[df["題目"].str.contains(keyword, na=False)] if keyword else df
-
-                if not result.empty:
-                    # Create a unique identifier for the selectbox
-                    options_list = result.apply(lambda x: f"{x['章節']}-{x['題號']} {x['題目']}", axis=1).tolist()
-                    selected_label = st.selectbox("選擇題目", options_list, key="select_question_edit")
+                search = perf.cached_call("load_search_index", load_search_index, *bank_key)
+                # Re-index only the questions with pending edits (made here or by another worker)
+                with perf.span("admin_search"):
+                    search.refresh(df, [bank_index.positions[k] for k in edit_overlay.edited_keys() if k in bank_index.positions])
+                    result_rows = search.search(keyword)
 
-                    # Find the row based on the selected label
-                    selected_row_data = result[result.apply(lambda x: f"{x['章節']}-{x['題號']} {x['題目']}", axis=1) == selected_label].iloc[0]
+                if result_rows:
+                    # Options are stable row ids, so the chosen question needs no second lookup
+                    selected_row = st.selectbox("選擇題目", result_rows, format_func=lambda r: search.labels[r], key="select_question_edit")
+                    selected_row_data = df.iloc[selected_row]
 
                     # Display and allow editing fields
                     st.write(f"目前章節-題號: {selected_row_data.get('章節', 'N/A')}-{selected_row_data.get('題號', 'N/A')}")
@@ -197,354 +280,420 @@ if st.session_state.is_admin_mode:
                     new_expl = st.text_area("解析", selected_row_data.get("解析", ""), key="edit_expl")
 
                     if st.button("✅ 更新題目", key="update_question_button"):
-                        try:
-                            wb = load_workbook(EXCEL_PATH)
-                            ws = wb[SHEET_NAME]
-                            # Find the row by 章節 and 題號 to update
-                            for row in ws.iter_rows(min_row=2): # Assuming header is row 1
-                                # Convert to string for comparison to handle potential mixed types
-                                if str(row[0].value) == str(selected_row_data.get("章節", None)) and str(row[1].value) == str(selected_row_data.get("題號", None)):
-                                    # Update option cells (assuming columns C, D, E, F are A, B, C, D - index 2, 3, 4, 5)
-                                    row[2].value = new_A # Column C for Option A
-                                    row[3].value = new_B # Column D for Option B
-                                    row[4].value = new_C # Column E for Option C
-                                    row[5].value = new_D # Column F for Option D
-                                    # Update explanation cell (assuming column J is 解析 - index 9)
-                                    row[9].value = new_expl
-                                    break # Found and updated the row
-                            wb.save(EXCEL_PATH)
-                            st.success("✅ 題目已更新成功")
-                            # Invalidate cache so next load_data gets the updated data
-                            st.cache_data.clear()
-                            # No need to rerun here unless you want the selectbox options to update immediately, which might be jarring.
-                            # A full rerun happens implicitly on button click anyway.
-
-                        except FileNotFoundError:
-                             st.error(f"錯誤：找不到題庫檔案 `{EXCEL_PATH}` 無法儲存。")
-                        except Exception as e:
-                             st.error(f"更新題目時發生錯誤：{e}")
+                        if not all(str(v).strip() for v in (new_A, new_B, new_C, new_D)):
+                            st.error("選項 A-D 不可空白。")
+                        else:
+                            try:
+                                # Only this question changes in the shared bank; other cached data stays valid
+                                with perf.span("admin_update"):
+                                    edit_overlay.set(
+                                        bank.question_key(selected_row_data.get("章節"), selected_row_data.get("題號")),
+                                        {"A": new_A, "B": new_B, "C": new_C, "D": new_D, "解析": new_expl},
+                                        df,
+                                        bank_index
+                                    )
+                                st.success("✅ 題目已更新成功")
+                            except Exception as e:
+                                 st.error(f"更新題目時發生錯誤：{e}")
+
+                    # Pending edits are written back to the workbook in one pass
+                    pending_edits = edit_overlay.pending()
+                    if pending_edits:
+                        st.caption(f"尚有 {pending_edits} 題的編輯尚未寫回題庫檔案。")
+                        if st.button("💾 寫回題庫檔案", key="compact_edits_button"):
+                            try:
+                                with perf.span("admin_compact"):
+                                    written = edit_overlay.compact(df, bank_index)
+                                st.success(f"已將 {written} 題的編輯寫回 `{current_bank.excel_path}`")
+                            except FileNotFoundError:
+                                 st.error(f"錯誤：找不到題庫檔案 `{current_bank.excel_path}` 無法儲存。")
+                            except Exception as e:
+                                 st.error(f"寫回題庫檔案時發生錯誤：{e}")
 
                 else:
                     st.info("找不到符合搜尋條件的題目。")
 
+        elif tool == "題庫檢查":
+            st.subheader("🩺 題庫檢查")
+            # Computed once when the bank was loaded; quarantined questions are never drawn into a quiz
+            issues = bank_index.issues
+            if issues.empty:
+                st.success(f"全部 {len(df)} 題皆通過檢查。")
+            else:
+                st.warning(f"{len(issues)} / {len(df)} 題未通過檢查，已暫停出題。請修正 `{current_bank.excel_path}` 後重新載入。")
+                st.dataframe(issues, hide_index=True)
+
+            st.markdown("**相似題目**")
+            clusters = duplicate_index.report(df)
+            if clusters.empty:
+                st.success("未發現相似題目。")
+            else:
+                st.info(f"發現 {duplicate_index.cluster_count} 組相似題目 (共 {len(clusters)} 題，題目與選項的相似度 ≥ {duplicate_index.threshold:.0%})。"
+                        "出題時可勾選「避免相似題目出現在同一次測驗」。")
+                st.dataframe(clusters, hide_index=True)
+
         elif tool == "錯題紀錄管理":
             st.subheader("🧹 管理錯題紀錄")
+            legacy_wrong_log = current_bank.data_path(LEGACY_WRONG_LOG)
+            if os.path.exists(legacy_wrong_log):
+                if st.button(f"📥 匯入舊版錯題紀錄 `{legacy_wrong_log}`", key="import_legacy_wrong_button"):
+                    try:
+                        imported = wrong_store.import_csv(legacy_wrong_log) # The index sees the change and rebuilds
+                        st.success(f"已匯入 {imported} 筆錯題紀錄 (重複的紀錄已略過)")
+                    except Exception as e:
+                        st.error(f"匯入舊版錯題紀錄時發生錯誤：{e}")
+
             submode = st.radio("選擇清除方式", ["單一使用者", "全部使用者"], key="clear_wrong_radio")
-            if os.path.exists(WRONG_LOG):
+            try:
+                unique_users = wrong_store.users()
+                if not unique_users:
+                     st.info("錯題紀錄中沒有使用者紀錄。")
+                else:
+                    if submode == "單一使用者":
+                        target_user = st.selectbox("選擇要清除錯題的使用者", unique_users, key="select_user_clear")
+                        if st.button(f"🧹 清除使用者 `{target_user}` 的錯題", key="clear_single_wrong_button"):
+                            wrong_index.clear_user(target_user)
+                            st.success(f"已清除使用者 `{target_user}` 的錯題紀錄")
+                            st.rerun() # Use st.rerun()
+
+                    elif submode == "全部使用者":
+                        st.warning("此操作將清除所有使用者的錯題紀錄，無法復原！")
+                        if st.button("🧨 確認清除全部錯題", key="clear_all_wrong_button"):
+                            wrong_index.clear_all()
+                            st.success("已清除所有錯題紀錄")
+                            st.rerun() # Use st.rerun()
+            except Exception as e:
+                st.error(f"讀取或處理錯題紀錄時發生錯誤：{e}")
+
+
+        elif tool == "批次閱卷":
+            st.subheader("📝 批次閱卷")
+            st.caption(f"上傳答案卡 CSV，欄位：{'、'.join(grading.SHEET_COLUMNS)}（可另附「時間」）。")
+            uploaded = st.file_uploader("上傳答案卡", type=["csv"], key="grading_upload")
+            if uploaded is None:
+                st.session_state.grading = None
+            elif df.empty:
+                st.warning("題庫資料為空，無法閱卷。")
+            else:
+                # Grade once per uploaded file; reruns (e.g. the write button) reuse the result
+                if st.session_state.grading is None or st.session_state.grading[0] != uploaded.file_id:
+                    try:
+                        with perf.span("grade_sheets"):
+                            result = grading.GradeResult(grading.read_sheets(uploaded), df, bank_index)
+                        st.session_state.grading = (uploaded.file_id, result)
+                    except ValueError as e:
+                        st.error(str(e))
+                        st.session_state.grading = None
+                    except Exception as e:
+                        st.error(f"讀取答案卡時發生錯誤：{e}")
+                        st.session_state.grading = None
+
+                if st.session_state.grading is not None:
+                    result = st.session_state.grading[1]
+                    scores = result.scores()
+                    st.success(f"已批改 {len(result.sheets) - result.skipped} 筆作答，共 {len(scores)} 位使用者。")
+                    if result.skipped:
+                        st.warning(f"有 {result.skipped} 筆作答無法批改（找不到題目、題目已隔離或缺少使用者名稱）。")
+                        with st.expander("檢視無法批改的作答"):
+                            st.dataframe(result.skipped_rows(), hide_index=True)
+
+                    st.markdown("**使用者成績**")
+                    st.dataframe(scores, hide_index=True)
+                    st.markdown("**各題錯誤率**")
+                    st.dataframe(result.question_stats(df), hide_index=True)
+
+                    if st.button("📥 將答錯題目寫入錯題紀錄", key="grading_log_wrong_button"):
+                        try:
+                            # One batched insert; pairs already in the log are skipped by the store
+                            with perf.span("grade_log_wrong"):
+                                inserted = wrong_index.add(result.wrong_entries(df))
+                            st.success(f"已新增 {inserted} 筆錯題紀錄 (重複的紀錄已略過)")
+                        except Exception as e:
+                            st.error(f"寫入錯題紀錄時發生錯誤：{e}")
+
+        elif tool == "學習分析":
+            st.subheader("📈 學習分析")
+            if st.button("🔄 由答題統計重建彙總", key="rebuild_rollups_button"):
                 try:
-                    df_wrong = pd.read_csv(WRONG_LOG)
-                    unique_users = df_wrong["使用者"].unique().tolist()
-                    if not unique_users:
-                         st.info("錯題紀錄中沒有使用者紀錄。")
-                    else:
-                        if submode == "單一使用者":
-                            target_user = st.selectbox("選擇要清除錯題的使用者", unique_users, key="select_user_clear")
-                            if st.button(f"🧹 清除使用者 `{target_user}` 的錯題", key="clear_single_wrong_button"):
-                                df_wrong = df_wrong[df_wrong["使用者"].str.lower() != target_user.lower()]
-                                df_wrong.to_csv(WRONG_LOG, index=False)
-                                st.success(f"已清除使用者 `{target_user}` 的錯題紀錄")
-                                st.rerun() # Use st.rerun()
-
-                        elif submode == "全部使用者":
-                            st.warning("此操作將清除所有使用者的錯題紀錄，無法復原！")
-                            if st.button("🧨 確認清除全部錯題", key="clear_all_wrong_button"):
-                                os.remove(WRONG_LOG)
-                                st.success("已清除所有錯題紀錄檔案")
-                                st.rerun() # Use st.rerun()
-                except pd.errors.EmptyDataError:
-                    st.info("錯題紀錄檔案為空。")
-                except FileNotFoundError:
-                     st.info("錯題紀錄檔案不存在。")
+                    # Runs on the writer thread, after the buffered events are on disk
+                    read = stats_writer.call(lambda: rollup_store.rebuild(stats_path))
+                    st.success(f"已由 {read:,} 筆答題統計重建彙總")
                 except Exception as e:
-                    st.error(f"讀取或處理錯題紀錄時發生錯誤：{e}")
-            else:
-                st.info("錯題紀錄檔案不存在。")
+                    st.error(f"重建答題彙總時發生錯誤：{e}")
 
+            try:
+                # Reads only the rollup tables; the raw answer log is never scanned here
+                attempts, correct, user_count = rollup_store.totals()
+                if attempts == 0:
+                    st.info("尚無答題紀錄。")
+                else:
+                    col1, col2, col3 = st.columns(3)
+                    col1.metric("作答總數", f"{attempts:,}")
+                    col2.metric("整體正確率", f"{correct / attempts:.1%}")
+                    col3.metric("使用者數", f"{user_count:,}")
+
+                    st.markdown("**最難題目排行**")
+                    min_attempts = st.number_input("最少作答人次", min_value=1, value=5, key="rollup_min_attempts")
+                    hardest = rollup_store.hardest_questions(limit=20, min_attempts=min_attempts)
+                    if hardest.empty:
+                        st.info("沒有作答人次達到門檻的題目。")
+                    else:
+                        hardest.insert(2, "題目", [
+                            df["題目"].iloc[bank_index.positions[key]] if key in bank_index.positions else "(已不在題庫中)"
+                            for key in zip(hardest["章節"], hardest["題號"])
+                        ])
+                        st.dataframe(hardest, hide_index=True)
+
+                    st.markdown("**各章節正確率 (作答最多的使用者)**")
+                    import altair as alt # Only this chart needs it; keeps it out of app startup
+                    accuracy = rollup_store.section_accuracy(max_users=30)
+                    heatmap = alt.Chart(accuracy).mark_rect().encode(
+                        x=alt.X("章節:N", sort="ascending"),
+                        y=alt.Y("使用者:N", sort=None),
+                        color=alt.Color("正確率:Q", scale=alt.Scale(domain=[0, 1], scheme="redyellowgreen")),
+                        tooltip=["使用者", "章節", "作答題數", alt.Tooltip("正確率:Q", format=".1%")]
+                    )
+                    st.altair_chart(heatmap)
+            except Exception as e:
+                st.error(f"讀取答題彙總時發生錯誤：{e}")
 
         elif tool == "下載統計":
             st.subheader("📊 下載統計資料")
-            if os.path.exists(STATS_LOG):
-                try:
-                    with open(STATS_LOG, "rb") as f:
-                        st.download_button(
-                            label="📥 下載答題統計 (CSV)",
-                            data=f,
-                            file_name="答題統計.csv",
-                            mime="text/csv",
-                            key="download_stats_button"
-                        )
-                except Exception as e:
-                    st.error(f"讀取答題統計檔案時發生錯誤：{e}")
+            if os.path.exists(stats_path):
+                def read_stats_log():
+                    # Runs only when the button is clicked, after the writer has flushed its buffer
+                    stats_writer.flush()
+                    with open(stats_path, "rb") as f:
+                        return f.read()
+
+                st.download_button(
+                    label="📥 下載答題統計 (CSV)",
+                    data=read_stats_log,
+                    file_name=os.path.basename(stats_path),
+                    mime="text/csv",
+                    key="download_stats_button"
+                )
             else:
                 st.info("答題統計檔案不存在。")
 
-    elif admin_pwd != "": # Show message if password is wrong but not empty
-         st.error("密碼錯誤")
-
+            st.markdown("**個人報表**")
+            st.caption("每位使用者一份報表，內含各章節成績與錯題紀錄，打包為一個 ZIP 檔。")
+            reports_path = os.path.join(bank.SNAPSHOT_DIR, current_bank.data_path(REPORTS_ZIP))
+            report_format = st.radio("報表格式", ["xlsx", "csv"], horizontal=True, key="report_format_radio")
+            if st.button("🗂️ 產生個人報表 ZIP", key="build_reports_button"):
+                progress_bar = st.progress(0.0, text="正在產生個人報表...")
 
-# Display Quiz Interface if not in Admin Mode and quiz is started
-# ... (前面的程式碼都保留) ...
+                def show_progress(done, total):
+                    progress_bar.progress(done / total, text=f"已完成 {done:,} / {total:,} 位使用者")
 
-# Display Quiz Interface if not in Admin Mode and quiz is started
-# ... (code before the else: # st.session_state.is_admin_mode is False block) ...
+                try:
+                    stats_writer.flush() # The rollups include every answer given so far
+                    with perf.span("build_reports"):
+                        user_count = reports.export_reports(
+                            current_bank.data_path(WRONG_LOG), current_bank.data_path(ROLLUP_DB),
+                            reports_path, fmt=report_format, progress=show_progress
+                        )
+                    progress_bar.empty()
+                    st.success(f"已產生 {user_count:,} 位使用者的個人報表")
+                except Exception as e:
+                    progress_bar.empty()
+                    st.error(f"產生個人報表時發生錯誤：{e}")
+
+            if os.path.exists(reports_path):
+                def read_reports():
+                    # Read when the button is clicked, so the page render never loads the archive
+                    with open(reports_path, "rb") as f:
+                        return f.read()
+
+                built_at = datetime.fromtimestamp(os.path.getmtime(reports_path)).strftime("%Y-%m-%d %H:%M")
+                st.download_button(
+                    label=f"📥 下載個人報表 ZIP ({built_at} 產生)",
+                    data=read_reports,
+                    file_name=os.path.basename(reports_path),
+                    mime="application/zip",
+                    key="download_reports_button"
+                )
 
-# Display Quiz Interface if not in Admin Mode and quiz is started
-else: # st.session_state.is_admin_mode is False
-    if st.session_state.quiz_started and st.session_state.questions is not None and not st.session_state.questions.empty:
-        total_questions = len(st.session_state.questions)
-        # all_answered = True # <-- Still removed
+        elif tool == "效能監控":
+            st.subheader("⏱️ 效能監控")
+            monitoring = st.checkbox("啟用效能監控", value=perf.enabled(), key="perf_enabled_checkbox")
+            if monitoring != perf.enabled():
+                perf.set_enabled(monitoring)
 
-        # Collect answers in a temporary list for this render cycle
-        temp_user_answers = []
+            span_rows = perf.span_summary()
+            if span_rows:
+                st.markdown("**執行時間 (最近樣本的百分位數)**")
+                st.dataframe(pd.DataFrame(span_rows), hide_index=True, width="stretch")
+            else:
+                st.info("尚無效能紀錄。")
+
+            cache_counts = perf.counters()
+            if cache_counts:
+                st.markdown("**快取與事件計數**")
+                st.dataframe(
+                    pd.DataFrame([{"類別": name, "項目": label, "次數": n} for (name, label), n in sorted(cache_counts.items())]),
+                    hide_index=True, width="stretch"
+                )
 
-        for i, row in st.session_state.questions.iterrows():
-            question_key = f"q{i}_quiz" # Unique key for the radio button in quiz mode
+            st.caption(
+                f"作答進度：記憶體中 {quiz_sessions.resident_count():,} / {quiz_sessions.max_resident:,} 個測驗，"
+                f"磁碟中 {quiz_sessions.spilled_count():,} 個 (閒置 {quiz_sessions.idle_seconds:g} 秒後寫出；還原時間見 session_restore)"
+            )
+            current_quiz = quiz_sessions.get(st.session_state.quiz_key) if st.session_state.quiz_key else None
+            if current_quiz is not None:
+                st.caption(f"目前 session 的測驗狀態約 {current_quiz.state.nbytes():,} bytes (寫出後約 {len(current_quiz.state.dumps()):,} bytes)")
 
-            # Find if this question was answered in a previous rerun within this quiz session
-            # Here, we need the potentially *previously* stored answer to set the initial state (index, disabled)
-            # Ensure comparison keys are strings for robustness
-            answered_item = next((item for item in st.session_state.user_answers
-                                  if str(item.get("章節")) == str(row.get("章節")) and str(item.get("題號")) == str(row.get("題號"))), None)
+            export_col, reset_col = st.columns(2)
+            if export_col.button("📤 匯出 Prometheus 指標", key="export_perf_button"):
+                try:
+                    perf.export_prometheus(PERF_METRICS_PATH)
+                    st.success(f"已寫出 `{PERF_METRICS_PATH}`")
+                except Exception as e:
+                    st.error(f"匯出效能指標時發生錯誤：{e}")
+            if reset_col.button("🧹 清除效能紀錄", key="reset_perf_button"):
+                perf.reset()
+                st.rerun()
 
-            with st.container():
-                st.markdown(f"**Q{i + 1}. {row.get('題目', 'N/A')}**") # Use .get for safety
-                # Get original options text and labels
-                options = [row.get('A', ''), row.get('B', ''), row.get('C', ''), row.get('D', '')]
-                labels = ['A', 'B', 'C', 'D']
-
-                # Handle potential None values in options gracefully
-                options = [str(opt) if opt is not None else "" for opt in options] # Changed "N/A" to "" for cleaner display
-
-                # Shuffle options only once per question per session
-                shuffled_key = f"q{i}_options_quiz"
-                if shuffled_key not in st.session_state.shuffled_options:
-                    zipped = list(zip(labels, options))
-                    random.shuffle(zipped)
-                    st.session_state.shuffled_options[shuffled_key] = zipped
-                else:
-                    zipped = st.session_state.shuffled_options[shuffled_key]
+    elif admin_pwd != "": # Show message if password is wrong but not empty
+         st.error("密碼錯誤")
 
-                # Create mappings from the *shuffled* order
-                shuffled_labels = [item[0] for item in zipped]
-                shuffled_options_text = [item[1] for item in zipped]
-                label_to_opt_shuffled = dict(zipped) # {'Shuffled_Label': 'Shuffled_Text'}
-                opt_to_label_shuffled = {v: k for k, v in label_to_opt_shuffled.items()} # {'Shuffled_Text': 'Shuffled_Label'}
 
-                # We still need the original mapping for correct_text lookup
-                original_label_to_opt = {'A': row.get('A', ''), 'B': row.get('B', ''), 'C': row.get('C', ''), 'D': row.get('D', '')}
+# Display Quiz Interface if not in Admin Mode and quiz is started
+else: # st.session_state.is_admin_mode is False
+    # Restored from disk if the quiz was spilled while idle (timed as session_restore)
+    saved_quiz = quiz_sessions.get(st.session_state.quiz_key) if st.session_state.quiz_key else None
+    quiz_state = saved_quiz.state if saved_quiz is not None else None
+    if st.session_state.quiz_started and quiz_state is None:
+        # Dropped after completion, or taken over by another session of the same user after it was spilled
+        st.warning("找不到這次測驗的作答進度 (可能已結束或已在其他分頁接續作答)，請重新出題。")
+        st.session_state.quiz_started = False
+    if st.session_state.quiz_started and quiz_state is not None and quiz_state.checked_key != bank_key:
+        # Row ids refer to the bank they were drawn from: checked once per loaded bank (e.g. after a restore or a workbook update)
+        if quiz_state.matches(df):
+            quiz_state.checked_key = bank_key
+        else:
+            st.warning("題庫已更新，請重新出題。")
+            st.session_state.quiz_started = False
+            quiz_sessions.discard(st.session_state.quiz_key) # Never resumed again
 
+    if st.session_state.quiz_started and quiz_state is not None and len(quiz_state.rows) > 0:
+        total_questions = len(quiz_state.rows)
 
-                correct_label = str(row.get("解答", "")).strip().upper()
-                # Validate correct label - Keep this check for displaying errors
-                if correct_label not in labels or not correct_label:
-                    st.error(f"題目 {row.get('章節', 'N/A')}-{row.get('題號', 'N/A')} 的解答格式錯誤：'{row.get('解答', 'None')}'。應為 A, B, C, 或 D。此題無法作答。")
-                    continue # Skip this question's radio button and processing
+        # Only the questions of the current page are rendered
+        # Read from the widget state: the sidebar selectbox is not drawn on the rerun that leaves admin mode
+        page_size_option = st.session_state.get("page_size_select", "全部")
+        page_size = total_questions if page_size_option == "全部" else int(page_size_option)
+        page_count = -(-total_questions // page_size)
+        st.session_state.quiz_page = max(0, min(st.session_state.quiz_page, page_count - 1))
+        page_start = st.session_state.quiz_page * page_size
+        page_end = min(page_start + page_size, total_questions)
 
-                # Get the correct answer text using the original mapping
-                correct_text = original_label_to_opt.get(correct_label, "無效的解答選項文字")
+        if page_count > 1:
+            st.progress(quiz_state.answered_count / total_questions, text=f"已回答 {quiz_state.answered_count} / {total_questions} 題")
 
+        render_span = perf.span("render_loop")
+        for q in quiz_state.questions(df, page_start, page_end):
+            question_key = f"q{q.position}_quiz" # Unique key for the radio button in quiz mode
 
-                # --- START: Adjusted Section for conditional display and index ---
+            # Answer recorded in a previous rerun within this quiz session (keyed lookup)
+            answered_item = quiz_state.answers.get(q.row)
 
-                display_options = [] # List to hold options shown in st.radio
-                selected_index_for_radio = None # Index for st.radio pre-selection
+            with st.container():
+                st.markdown(f"**Q{q.position + 1}. {q.text}**")
 
-                # Build the list of options to display and determine the pre-selected index if answered
+                # If answered, format options with label (e.g., "A. Option Text") and preselect the answer;
+                # otherwise display only the option text, in the shuffled order
                 if answered_item is not None:
-                    # If answered, format options with label (e.g., "A. Option Text")
-                    # Use the labels and texts from the *shuffled* zipped list
-                    answered_content_text = answered_item.get("使用者內容")
-                    for idx, (label, opt_text) in enumerate(zipped):
-                        formatted_option = f"{label}. {opt_text}"
-                        display_options.append(formatted_option)
-                        # Find the index if this option text matches the user's previous answer content
-                        if opt_text == answered_content_text:
-                             selected_index_for_radio = idx
-
+                    display_options = [f"{label}. {text}" for label, text in q.choices]
+                    selected_index_for_radio = q.choice_index(answered_item.label)
                 else:
-                    # If not answered, display only the option text (e.g., "Option Text")
-                    # Use the texts from the *shuffled* zipped list
-                    for idx, (label, opt_text) in enumerate(zipped):
-                        display_options.append(opt_text)
-                    # selected_index_for_radio remains None initially for unanswered questions
-
-
-                # --- END: Adjusted Section for conditional display and index ---
+                    display_options = [text for _, text in q.choices]
+                    selected_index_for_radio = None
 
-
-                # Display radio buttons using the conditionally built display_options list
-                # If answered_item is not None, index will be set and disabled=True
-                # If answered_item is None, index will be None and disabled=False
                 selected = st.radio("選項：", display_options,
                                      key=question_key,
-                                     index=selected_index_for_radio, # Use the determined index
+                                     index=selected_index_for_radio,
                                      disabled=answered_item is not None) # Disable if already answered
 
-                # --- START: Adjusted Section for processing selected answer and feedback ---
                 # If the user selected an answer in this rerun AND it wasn't previously answered
                 if selected is not None and answered_item is None:
-                    # In this block (answered_item is None), 'selected' is the raw option text
-                    user_selected_option_text = selected
-
-                    # Find the original label (A, B, C, D) corresponding to this text
-                    # Use the opt_to_label_shuffled mapping which correctly maps text to its shuffled label
-                    user_ans_label = opt_to_label_shuffled.get(user_selected_option_text)
-
-                    # Determine correctness based on the original correct_label and the user's chosen label
-                    is_correct = (user_ans_label == correct_label)
-
-                    # Add to temporary list for this render cycle's new answers
-                    temp_user_answers.append({
+                    user_ans_label = q.label_of.get(selected)
+                    answered_at = time.time()
+                    is_correct = quiz_state.record(q, user_ans_label, answered_at)
+                    # Another session's eviction may have spilled this quiz during the rerun; keep the updated state resident
+                    quiz_sessions.put(st.session_state.quiz_key, saved_quiz.resume_key, quiz_state, saved_quiz.settings)
+                    answered_item = quiz_state.answers[q.row]
+
+                    # Queue the answer event for the stats log; the background writer does the disk I/O
+                    stats_writer.record({
                         "使用者": st.session_state.username,
-                        "時間": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "正確答案": correct_label, # Store the original correct label
-                        "正確內容": correct_text, # Store the original correct text
-                        "使用者答案": user_ans_label if user_ans_label is not None else "未選", # Store the user's chosen label (A, B, C, D based on shuffle)
-                        "使用者內容": user_selected_option_text, # Store the original option text content user selected
-                        "章節": row.get("章節", "N/A"),
-                        "題號": row.get("題號", "N/A"),
-                        "題目": row.get("題目", "N/A"),
-                        "解析": row.get("解析", "無解析"),
-                        "是否正確": is_correct
+                        "時間": datetime.fromtimestamp(answered_at).strftime("%Y-%m-%d %H:%M:%S"),
+                        "章節": q.section,
+                        "題號": q.number,
+                        "使用者答案": user_ans_label if user_ans_label is not None else "未選",
+                        "是否正確": is_correct,
+                        "作答秒數": round(answered_at - st.session_state.answer_clock, 1)
                     })
+                    st.session_state.answer_clock = answered_at
+
+                    if quiz_state.drill:
+                        try:
+                            # Reschedule the drilled question; enough correct reviews in a row retire it
+                            wrong_index.review(st.session_state.username, q.row, is_correct, answered_at)
+                        except Exception as e:
+                            st.error(f"更新複習排程時發生錯誤：{e}")
 
-                    # Display feedback and explanation immediately after selection
-                    if is_correct:
+                # Display feedback and explanation for an answered question
+                if answered_item is not None:
+                    if answered_item.correct:
                         st.success(f"✅ 答對了！")
                     else:
-                        # Find the correct option text using the correct_label
-                        st.error(f"❌ 答錯了。正確答案是：{correct_label}. {correct_text}")
-
-                    # Display explanation
-                    st.markdown(f"※章節{row.get('章節', 'N/A')} 第{row.get('題號', 'N/A')}題解析：{row.get('解析', '無解析')}")
-
-                # If the question was already answered (in a previous rerun)
-                elif answered_item is not None:
-                    # Display feedback and explanation based on stored data.
-                    # The display_options contained formatted text ("A. Option Text") when this was rendered as answered.
-                    # We need the data from the stored answered_item for feedback.
-                    if answered_item.get("是否正確") is True:
-                         st.success(f"✅ 答對了！")
-                    else:
-                         st.error(f"❌ 答錯了。正確答案是：{answered_item.get('正確答案', 'N/A')}. {answered_item.get('正確內容', 'N/A')}")
-                    st.markdown(f"※{answered_item.get('章節', 'N/A')}第{answered_item.get('題號', 'N/A')}題解析：{answered_item.get('解析', '無解析')}")
-
-                # --- END: Adjusted Section for processing selected answer and feedback ---
-
+                        st.error(f"❌ 答錯了。正確答案是：{q.correct_label}. {q.correct_text}")
+                    st.markdown(f"※章節{q.section} 第{q.number}題解析：{q.explanation}")
 
-        # Append newly recorded answers (from this rerun) to the session state list
-        st.session_state.user_answers.extend(temp_user_answers)
 
-        # --- Recalculate all_answered and correct_count after the loop ---
-        # Invalidate questions with invalid correct answers
-        valid_questions_in_quiz_keys = [
-            (str(q.get("章節", "")), str(q.get("題號", "")))
-            for _, q in st.session_state.questions.iterrows()
-            if str(q.get("解答", "")).strip().upper() in ['A', 'B', 'C', 'D']
-        ]
-        total_valid_questions = len(valid_questions_in_quiz_keys)
+        if page_count > 1:
+            prev_col, page_col, next_col = st.columns([1, 2, 1])
+            prev_col.button("⬅️ 上一頁", key="prev_page_button", on_click=change_quiz_page, args=(-1,),
+                            disabled=st.session_state.quiz_page == 0)
+            page_col.markdown(f"第 {st.session_state.quiz_page + 1} / {page_count} 頁 (第 {page_start + 1}-{page_end} 題)")
+            next_col.button("下一頁 ➡️", key="next_page_button", on_click=change_quiz_page, args=(1,),
+                            disabled=st.session_state.quiz_page >= page_count - 1)
 
-        # Count how many valid questions in the current quiz have an answer recorded in session_state.user_answers
-        answered_valid_question_keys = set(
-            (str(item.get("章節", "")), str(item.get("題號", "")))
-            for item in st.session_state.user_answers
-            if (str(item.get("章節", "")), str(item.get("題號", ""))) in valid_questions_in_quiz_keys
-        )
 
-        # all_answered is true if the count of answered valid questions matches the total count of valid questions
-        all_answered = len(answered_valid_question_keys) == total_valid_questions and total_valid_questions > 0
+        render_span.stop()
 
-
-        # Recalculate correct count by iterating through the *current quiz questions*
-        correct_count = 0
-        for _, q_row in st.session_state.questions.iterrows():
-             q_key = (str(q_row.get("章節")), str(q_row.get("題號")))
-             # Only count if the question is valid and an answer is recorded for it
-             if q_key in valid_questions_in_quiz_keys:
-                  answered_item = next((item for item in st.session_state.user_answers
-                                        if (str(item.get("章節")), str(item.get("題號"))) == q_key), None)
-                  # If an answer was found and it was correct
-                  if answered_item is not None and answered_item.get("是否正確") is True:
-                       correct_count += 1
+        # --- Results from the running counters (quizzes hold only validated questions) ---
+        correct_count = quiz_state.correct_count
+        all_answered = quiz_state.answered_count == total_questions
 
 
         # --- Display Results and Restart Button ---
         if all_answered:
             st.markdown("---")
-            st.markdown(f"### 🎯 本次測驗結果：總計 {total_valid_questions} 題，答對 {correct_count} 題")
-
-            # --- Logging Wrong Answers (after quiz completion) ---
-            # Only log wrong answers that were *newly recorded* in the temp_user_answers list during this completion render
-            wrong_answers_this_quiz_run = [
-                 item for item in temp_user_answers # Use temp_user_answers
-                 if item.get("是否正確") is False
-             ]
+            st.markdown(f"### 🎯 本次測驗結果：總計 {total_questions} 題，答對 {correct_count} 題")
 
-            if wrong_answers_this_quiz_run:
+            # --- Logging Wrong Answers (once, after quiz completion) ---
+            # Drill answers were already rescheduled one by one, so only regular quizzes log here
+            if quiz_state.drill:
+                quiz_state.wrong_logged = True
+            if not quiz_state.wrong_logged:
                  try:
-                     # Load existing log or create new
-                     if os.path.exists(WRONG_LOG):
-                         df_wrong_log = pd.read_csv(WRONG_LOG)
-                     else:
-                         # Define columns explicitly for a new dataframe
-                         df_wrong_log = pd.DataFrame(columns=["使用者", "時間", "章節", "題號", "題目", "使用者答案", "使用者內容", "正確答案", "正確內容", "解析"])
-
-                     # Append new wrong answers, avoiding duplicates for the same user/question combination
-                     new_wrong_entries = []
-                     # Create a set of existing wrong answers by user, chapter, question number (as strings)
-                     existing_wrong_keys = set(tuple(map(str, row[["使用者", "章節", "題號"]].tolist())) for _, row in df_wrong_log.iterrows())
-
-                     for entry in wrong_answers_this_quiz_run:
-                         entry_key = (str(entry.get("使用者", "")), str(entry.get("章節", "")), str(entry.get("題號", "")))
-                         # Check if the question is valid AND the entry is not a duplicate in the log
-                         if (str(entry.get("章節", "")), str(entry.get("題號", ""))) in valid_questions_in_quiz_keys and entry_key not in existing_wrong_keys:
-                              entry_to_append = {
-                                  "使用者": entry.get("使用者", ""),
-                                  "時間": entry.get("時間", ""),
-                                  "章節": entry.get("章節", ""),
-                                  "題號": entry.get("題號", ""),
-                                  "題目": entry.get("題目", ""),
-                                  "使用者答案": entry.get("使用者答案", ""),
-                                  "使用者內容": entry.get("使用者內容", ""),
-                                  "正確答案": entry.get("正確答案", ""),
-                                  "正確內容": entry.get("正確內容", ""),
-                                  "解析": entry.get("解析", "")
-                              }
-                              new_wrong_entries.append(entry_to_append)
-                              existing_wrong_keys.add(entry_key)
-
-                     if new_wrong_entries:
-                         df_new_wrong = pd.DataFrame(new_wrong_entries)
-                         required_cols = ["使用者", "時間", "章節", "題號", "題目", "使用者答案", "使用者內容", "正確答案", "正確內容", "解析"]
-                         df_new_wrong = df_new_wrong.reindex(columns=required_cols)
-                         df_wrong_log = pd.concat([df_wrong_log, df_new_wrong], ignore_index=True)
-                         df_wrong_log.to_csv(WRONG_LOG, index=False)
-                         # st.info(f"已記錄 {len(new_wrong_entries)} 筆錯題到錯題紀錄。") # Optional: show confirmation
-
+                     # The store skips user/question pairs already logged
+                     with perf.span("log_wrong_answers"):
+                         wrong_index.add(quiz_state.wrong_entries(df, st.session_state.username))
+                     quiz_state.wrong_logged = True
                  except Exception as e:
                      st.error(f"記錄錯題時發生錯誤：{e}")
+            if quiz_state.wrong_logged and not saved_quiz.done:
+                # Completed: nothing left to resume, so the quiz is never spilled and its disk copy goes
+                quiz_sessions.finish(st.session_state.quiz_key)
 
 
             # --- Restart Button (in Main Area after results) ---
             if st.button("🔄 重新出題", key="restart_quiz_button_completed"):
-                 if st.session_state.last_settings:
-                     st.session_state.quiz_started = True
-                     st.session_state.user_answers = []
-                     st.session_state.shuffled_options = {}
-
-                     st.session_state.questions = generate_quiz_questions(
-                         st.session_state.last_settings["username"],
-                         st.session_state.last_settings["mode"],
-                         st.session_state.last_settings["selected_chapters"],
-                         st.session_state.last_settings["num_questions"],
-                         df,
-                         chapter_mapping,
-                         WRONG_LOG
-                     )
-
-                     if st.session_state.questions.empty:
-                         st.session_state.quiz_started = False
-                         # st.warning already inside generate_quiz_questions
+                 if saved_quiz.settings:
+                     start_new_quiz(saved_quiz.settings)
                      st.rerun()
 
                  else:
@@ -552,13 +701,13 @@ else: # st.session_state.is_admin_mode is False
 
         else:
             # Display progress
-            answered_count_for_current_quiz = len(answered_valid_question_keys)
             st.markdown("---")
-            st.info(f"已回答 {answered_count_for_current_quiz} / {total_valid_questions} 題。")
-            if total_valid_questions > 0:
-                 st.markdown("請繼續作答。")
-            elif total_questions > 0 and total_valid_questions == 0:
-                 st.warning("本次測驗中的所有題目解答格式均無效，無法完成作答。請通知管理者修正題庫。")
-            # else: total_questions == 0, handled by load_data or generate_quiz_questions
+            st.info(f"已回答 {quiz_state.answered_count} / {total_questions} 題。")
+            st.markdown("請繼續作答。")
 
     # Implicit else: If quiz_started is False, nothing is displayed in the main area except the title.
+
+
+rerun_span.stop()
+perf.maybe_export(PERF_METRICS_PATH)
+quiz_sessions.maybe_sweep() # Spills the quizzes left idle, at most every sweep_interval seconds
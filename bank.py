@@ -0,0 +1,392 @@
+"""Question bank loading, compiled Arrow snapshot, section index and edit overlay of the Excel workbook."""
+import json
+import os
+import re
+import threading
+import weakref
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+
+# 快照存放目錄 (相對於題庫檔案所在目錄)
+SNAPSHOT_DIR = ".cache"
+
+# 快照格式版本：題庫正規化方式改變時遞增，讓舊快照重建
+SNAPSHOT_FORMAT = b"2"
+
+# 管理者可編輯的欄位
+EDITABLE_COLUMNS = ["A", "B", "C", "D", "解析"]
+
+# 選項欄位 (亦為有效的解答標籤)
+OPTION_COLUMNS = ["A", "B", "C", "D"]
+
+# 以文字形式儲存的題目欄位 (缺值存為空字串)
+TEXT_COLUMNS = ["題目", "A", "B", "C", "D", "解析"]
+
+# 批次抽題時隨機鍵矩陣 (份數 x 題數) 的元素上限；超過時改為逐份抽題，記憶體只與抽出的題數成正比
+MAX_BATCH_KEYS = 1 << 20
+
+
+def question_key(section, number):
+    """Returns the (章節, 題號) key of a question as strings, the form used by every lookup."""
+    return (str(section), str(number))
+
+
+def source_signature(excel_path):
+    """Returns the (mtime_ns, size) of the workbook, or None if it does not exist."""
+    try:
+        stat = os.stat(excel_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def snapshot_path(excel_path, sheet_name, suffix=".arrow"):
+    """Returns the path of the compiled snapshot (or another cache file) for one sheet of a workbook."""
+    folder = os.path.join(os.path.dirname(excel_path) or ".", SNAPSHOT_DIR)
+    base = os.path.splitext(os.path.basename(excel_path))[0]
+    return os.path.join(folder, f"{base}.{sheet_name}{suffix}")
+
+
+def _signature_metadata(sheet_name, signature):
+    return {
+        b"sheet_name": sheet_name.encode("utf-8"),
+        b"format": SNAPSHOT_FORMAT,
+        b"source_mtime_ns": str(signature[0]).encode(),
+        b"source_size": str(signature[1]).encode(),
+    }
+
+
+def _key_text(value):
+    """Returns a 章節/題號 cell as text: missing -> "", 5.0 -> "5"."""
+    if value is None or value != value:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def _cell_text(value):
+    return "" if value is None or value != value else str(value)
+
+
+def normalize_questions(frame):
+    """Returns the bank with 章節/題號 as stripped text, 解答 as an upper-case label and text cells as str.
+
+    Done once when the workbook is compiled, so every later lookup compares plain strings.
+    """
+    frame = frame.copy()
+    for column in ("章節", "題號"):
+        if column in frame.columns:
+            frame[column] = frame[column].map(_key_text).astype(str)
+    if "解答" in frame.columns:
+        frame["解答"] = frame["解答"].map(lambda v: _cell_text(v).strip().upper()).astype(str)
+    for column in TEXT_COLUMNS:
+        if column in frame.columns:
+            frame[column] = frame[column].map(_cell_text).astype(str)
+    return frame
+
+
+def find_issues(frame):
+    """Checks every question once; returns (valid mask, report DataFrame of the invalid rows).
+
+    A row is invalid if its 章節, 題號, 題目 or any option is empty, its 解答 is not A-D, or its
+    (章節, 題號) repeats an earlier row. The report lists the workbook row number and the reasons.
+    """
+    def blank(column):
+        if column not in frame.columns:
+            return np.ones(len(frame), dtype=bool)
+        return (frame[column].str.strip() == "").to_numpy(dtype=bool)
+
+    problems = [(blank(column), reason) for column, reason in (("章節", "缺少章節"), ("題號", "缺少題號"), ("題目", "缺少題目"))]
+    problems += [(blank(column), f"選項 {column} 空白") for column in OPTION_COLUMNS]
+    answers = frame["解答"] if "解答" in frame.columns else pd.Series([""] * len(frame))
+    problems.append((~answers.isin(OPTION_COLUMNS).to_numpy(), "解答不是 A-D"))
+    if {"章節", "題號"} <= set(frame.columns):
+        problems.append((frame.duplicated(["章節", "題號"]).to_numpy(), "章節/題號與前面的題目重複"))
+
+    invalid = np.logical_or.reduce([mask for mask, _ in problems]) if len(frame) else np.zeros(0, bool)
+    rows = np.flatnonzero(invalid)
+    reasons = ["、".join(reason for mask, reason in problems if mask[row]) for row in rows]
+    report = pd.DataFrame({
+        "列": rows + 2, # Workbook row: header is row 1
+        "章節": frame["章節"].to_numpy()[rows] if "章節" in frame.columns else "",
+        "題號": frame["題號"].to_numpy()[rows] if "題號" in frame.columns else "",
+        "題目": frame["題目"].to_numpy()[rows] if "題目" in frame.columns else "",
+        "解答": answers.to_numpy()[rows],
+        "問題": reasons,
+    })
+    return ~invalid, report
+
+
+def _arrow_compatible(frame):
+    """Converts mixed-type object columns (e.g. a numeric option) to strings so Arrow can store them."""
+    frame = frame.copy()
+    for column in frame.columns:
+        if frame[column].dtype == object:
+            frame[column] = frame[column].map(lambda v: v if v is None or isinstance(v, str) or pd.isna(v) else str(v))
+    return frame
+
+
+def write_snapshot(frame, excel_path, sheet_name, signature):
+    """Writes the frame as an uncompressed Arrow IPC file tagged with the workbook signature."""
+    path = snapshot_path(excel_path, sheet_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    table = pa.Table.from_pandas(_arrow_compatible(frame), preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), **_signature_metadata(sheet_name, signature)})
+    # Write to a private temp file and rename, so concurrent readers never see a partial snapshot
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink:
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_snapshot(excel_path, sheet_name, signature):
+    """Memory-maps the snapshot and returns it as a DataFrame, or None if it is missing or stale."""
+    path = snapshot_path(excel_path, sheet_name)
+    try:
+        reader = ipc.open_file(pa.memory_map(path, "r"))
+    except (FileNotFoundError, pa.ArrowInvalid):
+        return None
+    metadata = reader.schema.metadata or {}
+    expected = _signature_metadata(sheet_name, signature)
+    if any(metadata.get(k) != v for k, v in expected.items()):
+        return None
+    # The mapped pages are shared through the OS page cache by every process reading this snapshot
+    return reader.read_all().to_pandas()
+
+
+def load_question_frame(excel_path, sheet_name):
+    """Loads one sheet of the question bank, rebuilding the snapshot only when the workbook changed."""
+    signature = source_signature(excel_path)
+    if signature is None:
+        raise FileNotFoundError(excel_path)
+
+    frame = read_snapshot(excel_path, sheet_name, signature)
+    if frame is not None:
+        return frame
+
+    frame = normalize_questions(pd.read_excel(excel_path, sheet_name=sheet_name))
+    try:
+        write_snapshot(frame, excel_path, sheet_name, signature)
+    except OSError:
+        return frame # Read-only deployment: serve the parsed workbook without caching it
+    # Serve the memory-mapped copy so this process shares its pages with the other workers
+    snapshot = read_snapshot(excel_path, sheet_name, signature)
+    return snapshot if snapshot is not None else frame
+
+
+EMPTY_ROWS = np.empty(0, dtype=np.int32)
+
+
+def _natural_key(text):
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", text)]
+
+
+def derive_chapter_mapping(sections):
+    """Groups section names by the part before the first "-": ["1-1", "1-2", "2-1"] -> {"CH1": ["1-1", "1-2"], "CH2": ["2-1"]}."""
+    mapping = {}
+    for section in sorted(sections, key=_natural_key):
+        mapping.setdefault(f"CH{section.split('-', 1)[0]}", []).append(section)
+    return mapping
+
+
+class BankIndex:
+    """Row positions of the bank grouped by section ("1-1") and by chapter key ("CH1"), and by question key.
+
+    Rows failing find_issues() are quarantined: they stay out of the section and chapter arrays
+    (so they are never sampled) and are listed in .issues for the admin report. Without an explicit
+    chapter_map the chapters are derived from the sections present in the sheet.
+    """
+
+    def __init__(self, frame, chapter_map=None):
+        self.sections = {}
+        self.positions = {}
+        self.valid, self.issues = find_issues(frame)
+        if not frame.empty:
+            keys = list(zip(frame["章節"], frame["題號"]))
+            # Built back to front so a repeated key points at its first (valid) row
+            self.positions = dict(zip(reversed(keys), range(len(keys) - 1, -1, -1)))
+            codes, uniques = pd.factorize(frame["章節"])
+            codes[~self.valid] = -1
+            order = np.argsort(codes, kind="stable").astype(np.int32)
+            # Shift by one so quarantined rows (code -1) sort into their own leading slot
+            bounds = np.cumsum(np.bincount(codes + 1, minlength=len(uniques) + 1))
+            for i, section in enumerate(uniques):
+                self.sections[section] = order[bounds[i]:bounds[i + 1]]
+            self.sections = {section: rows for section, rows in self.sections.items() if len(rows)}
+        self.chapter_map = chapter_map if chapter_map is not None else derive_chapter_mapping(self.sections)
+        self.chapters = {
+            chapter: np.concatenate([self.sections.get(s, EMPTY_ROWS) for s in sections] or [EMPTY_ROWS])
+            for chapter, sections in self.chapter_map.items()
+        }
+
+    def valid_rows(self, rows):
+        """Returns the rows that are not quarantined."""
+        return rows[self.valid[rows]]
+
+    def chapter_rows(self, selected_chapters):
+        """Returns the row arrays of the selected chapters (unknown keys are ignored)."""
+        return [self.chapters[ch] for ch in selected_chapters if ch in self.chapters]
+
+
+def sample_rows(row_arrays, num_questions, rng):
+    """Draws up to num_questions distinct row positions from the concatenation of row_arrays.
+
+    The arrays are never concatenated: positions are drawn in the combined range and mapped back
+    to their array, so the cost grows with the number of questions rather than the bank size.
+    """
+    lengths = np.array([len(rows) for rows in row_arrays], dtype=np.int64)
+    total = int(lengths.sum())
+    if total == 0:
+        return EMPTY_ROWS
+    picks = rng.choice(total, size=min(num_questions, total), replace=False)
+    ends = np.cumsum(lengths)
+    owners = np.searchsorted(ends, picks, side="right")
+    offsets = picks - (ends - lengths)[owners]
+    return np.array([row_arrays[o][i] for o, i in zip(owners, offsets)], dtype=np.int32)
+
+
+def sample_row_batches(rows, num_questions, batch_size, rng):
+    """Draws batch_size independent samples of num_questions distinct rows each; returns (batch_size, num_questions).
+
+    For small pools every sample is the num_questions smallest of fresh random keys over the rows,
+    so a whole batch is drawn with a few array operations. Once the key matrix would exceed
+    MAX_BATCH_KEYS entries, each sample is drawn with rng.choice(), whose cost grows with
+    num_questions rather than with the pool.
+    """
+    rows = np.asarray(rows, dtype=np.int32)
+    if num_questions > len(rows):
+        raise ValueError(f"只有 {len(rows)} 題可抽，無法抽出 {num_questions} 題")
+    if num_questions == 0:
+        return np.empty((batch_size, 0), dtype=np.int32)
+    if batch_size * len(rows) > MAX_BATCH_KEYS:
+        picks = np.empty((batch_size, num_questions), dtype=np.int64)
+        for i in range(batch_size):
+            picks[i] = rng.choice(len(rows), num_questions, replace=False) # Already in random order
+        return rows[picks]
+    keys = rng.random((batch_size, len(rows)))
+    picks = np.argpartition(keys, num_questions - 1, axis=1)[:, :num_questions]
+    # argpartition leaves the picks in no particular order; order them by key for a uniform shuffle
+    picks = np.take_along_axis(picks, np.argsort(np.take_along_axis(keys, picks, axis=1), axis=1), axis=1)
+    return rows[picks]
+
+
+class EditOverlay:
+    """Admin edits keyed by (章節, 題號), applied to the in-memory bank until compacted into the workbook.
+
+    Pending edits are kept in a small JSON journal next to the snapshot, so they survive restarts and
+    reach other worker processes (each one re-reads the journal when its mtime changes).
+    """
+
+    def __init__(self, excel_path, sheet_name):
+        self.excel_path = excel_path
+        self.sheet_name = sheet_name
+        self.path = snapshot_path(excel_path, sheet_name, ".edits.json")
+        self.edits = {}
+        self._journal_mtime = None
+        self._applied_to = None
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        """Re-reads the journal if another writer changed it. Returns True if it did."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._journal_mtime:
+            return False
+        edits = {}
+        if mtime is not None:
+            with open(self.path, encoding="utf-8") as f:
+                edits = {question_key(e["章節"], e["題號"]): e["changes"] for e in json.load(f)}
+        self.edits, self._journal_mtime = edits, mtime
+        return True
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump([{"章節": k[0], "題號": k[1], "changes": v} for k, v in self.edits.items()], f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self._journal_mtime = os.stat(self.path).st_mtime_ns
+
+    def _apply(self, frame, index, keys):
+        for key in keys:
+            pos = index.positions.get(key)
+            if pos is None:
+                continue # The question no longer exists in this bank
+            for column, value in self.edits[key].items():
+                frame.iloc[pos, frame.columns.get_loc(column)] = value
+
+    def sync(self, frame, index):
+        """Applies pending edits to a loaded bank frame in place, once per frame or journal change."""
+        with self._lock:
+            changed = self._reload()
+            if changed or self._applied_to is None or self._applied_to() is not frame:
+                self._apply(frame, index, list(self.edits))
+                self._applied_to = weakref.ref(frame)
+
+    def set(self, key, changes, frame, index):
+        """Records an edit of one question and applies it to the loaded frame; only that row changes."""
+        with self._lock:
+            self._reload()
+            self.edits.setdefault(key, {}).update(changes)
+            self._save()
+            self._apply(frame, index, [key])
+
+    def edited_keys(self):
+        """Returns the keys of the questions with edits not yet written to the workbook."""
+        with self._lock:
+            self._reload()
+            return list(self.edits)
+
+    def pending(self):
+        """Returns the number of questions with edits not yet written to the workbook."""
+        return len(self.edited_keys())
+
+    def compact(self, frame, index):
+        """Writes pending edits into the workbook by precomputed row number and refreshes the snapshot.
+
+        The snapshot is rebuilt from the in-memory frame (which already holds the edits), so workers
+        pick up the new workbook signature with a memory-mapped load instead of a full re-parse.
+        Returns the number of questions written.
+        """
+        with self._lock:
+            self._reload()
+            if not self.edits:
+                return 0
+            from openpyxl import load_workbook # Only this admin save path needs it; keeps it out of app startup
+            wb = load_workbook(self.excel_path)
+            ws = wb[self.sheet_name]
+            header = {cell.value: cell.column for cell in ws[1]}
+            key_columns = (header["章節"], header["題號"])
+            fallback_rows = None
+            for key, changes in self.edits.items():
+                pos = index.positions.get(key)
+                # Bank rows follow the sheet rows after the header, so the row number is position + 2
+                row = pos + 2 if pos is not None else None
+                if row is None or question_key(*(ws.cell(row=row, column=c).value for c in key_columns)) != key:
+                    if fallback_rows is None:
+                        # Blank rows in the sheet shift the numbering; map every key once instead of per edit
+                        fallback_rows = {
+                            question_key(*(r[c - 1].value for c in key_columns)): r[0].row
+                            for r in ws.iter_rows(min_row=2) if r[key_columns[0] - 1].value is not None
+                        }
+                    row = fallback_rows.get(key)
+                    if row is None:
+                        continue
+                for column, value in changes.items():
+                    ws.cell(row=row, column=header[column]).value = value
+            wb.save(self.excel_path)
+
+            written = len(self.edits)
+            write_snapshot(frame, self.excel_path, self.sheet_name, source_signature(self.excel_path))
+            self.edits = {}
+            os.remove(self.path)
+            self._journal_mtime = None
+            return written
@@ -0,0 +1,122 @@
+"""Registry of the question banks (題庫) in a directory: one entry per workbook sheet with the bank columns."""
+import json
+import logging
+import os
+
+from bank import SNAPSHOT_DIR
+
+# 題庫工作表必須具備的欄位
+REQUIRED_COLUMNS = ["章節", "題號", "題目", "A", "B", "C", "D", "解答"]
+
+# 各活頁簿的題庫工作表清單 (存放於 SNAPSHOT_DIR)，活頁簿未變更時免再開啟
+REGISTRY_FILE = "banks.json"
+
+logger = logging.getLogger(__name__)
+
+
+class BankSource:
+    """One question bank: a sheet of a workbook, and the names of the data files kept for it.
+
+    The default bank keeps the original data file names (錯題紀錄.db, 答題統計.csv, ...); every
+    other bank gets its own copies tagged with the workbook and sheet names, since questions of
+    different banks share (章節, 題號) keys.
+    """
+
+    __slots__ = ("id", "excel_path", "sheet_name", "label", "is_default")
+
+    def __init__(self, excel_path, sheet_name, label, is_default=False):
+        self.excel_path = excel_path
+        self.sheet_name = sheet_name
+        self.id = f"{os.path.basename(excel_path)}/{sheet_name}"
+        self.label = label
+        self.is_default = is_default
+
+    def data_path(self, name):
+        """Returns the per-bank path of a data file such as 錯題紀錄.db."""
+        if self.is_default:
+            return name
+        stem, ext = os.path.splitext(name)
+        base = os.path.splitext(os.path.basename(self.excel_path))[0]
+        return f"{stem}.{base}.{self.sheet_name}{ext}".replace(os.sep, "_")
+
+
+def directory_signature(directory):
+    """Returns the (name, mtime_ns, size) of every workbook in the directory; it changes when one is added or saved."""
+    signature = []
+    try:
+        names = sorted(os.listdir(directory))
+    except FileNotFoundError:
+        return ()
+    for name in names:
+        if name.lower().endswith(".xlsx") and not name.startswith(("~$", ".")):
+            stat = os.stat(os.path.join(directory, name))
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+def _bank_sheets(path):
+    """Returns the names of the sheets whose header row holds every required column."""
+    from openpyxl import load_workbook # Only needed when a workbook is new or changed
+    wb = load_workbook(path, read_only=True)
+    try:
+        sheets = []
+        for ws in wb.worksheets:
+            header = next(ws.iter_rows(max_row=1, values_only=True), ())
+            if set(REQUIRED_COLUMNS) <= {str(h).strip() for h in header if h is not None}:
+                sheets.append(ws.title)
+        return sheets
+    finally:
+        wb.close()
+
+
+def _read_registry(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _write_registry(path, registry):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(registry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass # Read-only deployment: scan again next time
+
+
+def discover_banks(directory, default_excel_path, default_sheet_name):
+    """Lists the banks in a directory (only header rows are read), with the default bank first.
+
+    The sheet list of each workbook is remembered with its (mtime_ns, size) in REGISTRY_FILE, so
+    a restart opens only the workbooks that were added or saved since the last scan.
+    """
+    registry_path = os.path.join(directory, SNAPSHOT_DIR, REGISTRY_FILE)
+    known = _read_registry(registry_path)
+    registry = {}
+    sources = []
+    default_path = os.path.normpath(default_excel_path)
+    for name, mtime_ns, size in directory_signature(directory):
+        path = os.path.normpath(os.path.join(directory, name))
+        entry = known.get(name)
+        if entry and entry["mtime_ns"] == mtime_ns and entry["size"] == size:
+            sheets = entry["sheets"]
+        else:
+            try:
+                sheets = _bank_sheets(path)
+            except Exception:
+                logger.exception("無法讀取題庫檔案 %s", path)
+                continue
+        registry[name] = {"mtime_ns": mtime_ns, "size": size, "sheets": sheets}
+        base = os.path.splitext(name)[0]
+        for sheet in sheets:
+            label = base if len(sheets) == 1 else f"{base} - {sheet}"
+            is_default = path == default_path and sheet == default_sheet_name
+            sources.append(BankSource(path, sheet, label, is_default))
+    if registry != known:
+        _write_registry(registry_path, registry)
+    sources.sort(key=lambda source: not source.is_default)
+    return sources
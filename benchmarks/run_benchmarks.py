@@ -0,0 +1,354 @@
+"""Benchmark suite for the quiz app on synthetic question banks and answer logs.
+
+Usage (from the repository root):
+
+    python benchmarks/run_benchmarks.py                       # 1k and 10k banks
+    python benchmarks/run_benchmarks.py --sizes 1k,10k,100k,1m
+    python benchmarks/run_benchmarks.py --save-baseline       # store the results as the new baseline
+
+Each size gets its own work directory with a synthetic 行銷題庫總表.xlsx (CH1-CH9), a wrong-answer
+log and a stats log for many users. The hot paths are timed both directly (bank, index, search and
+log modules) and end to end by running app.py headlessly through streamlit.testing.v1.AppTest.
+Startup is timed in fresh processes: the imports of app.py, and the first render with and without
+the serve.py prewarm. Results are written as JSON and compared with the stored baseline; any
+benchmark slower than the baseline by more than --threshold fails the run, and so does any startup
+benchmark over its budget in STARTUP_BUDGET_MS.
+"""
+import ast
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import numpy as np
+from openpyxl import Workbook
+
+import bank
+import search_index
+import stats_log
+import wrong_log
+
+APP_PATH = os.path.join(REPO_ROOT, "app.py")
+EXCEL_NAME = "行銷題庫總表.xlsx"
+SHEET_NAME = "題庫總表"
+BASELINE_PATH = os.path.join(REPO_ROOT, "benchmarks", "baseline.json")
+RESULTS_PATH = os.path.join(REPO_ROOT, "benchmarks", "results.json")
+CHAPTER_MAPPING = {f"CH{i}": [f"{i}-1", f"{i}-2"] for i in range(1, 10)}
+SIZES = {"1k": 1_000, "10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+# 啟動時間預算 (毫秒，取中位數)：與基準線無關，超過即判定失敗
+STARTUP_BUDGET_MS = {
+    "startup.import[1k]": 2000,
+    "startup.first_render[1k]": 3500,
+    "startup.first_render_prewarmed[1k]": 1000,
+    "startup.import[10k]": 2000,
+    "startup.first_render[10k]": 6000,
+    "startup.first_render_prewarmed[10k]": 1500,
+}
+
+# 在全新行程中執行，輸出 JSON 格式的毫秒數
+_STARTUP_SCRIPT = """
+import json, os, sys, time
+sys.path.insert(0, {repo!r})
+start = time.perf_counter()
+{imports}
+timings = {{"import": (time.perf_counter() - start) * 1000}}
+if {render}:
+    import logging
+    logging.disable(logging.WARNING)
+    import resources
+    from streamlit.testing.v1 import AppTest
+    if {prewarm}:
+        resources.prewarm()
+    render_start = time.perf_counter()
+    at = AppTest.from_file({app!r}, default_timeout=600).run()
+    assert not at.exception, [e.value for e in at.exception]
+    timings["render"] = (time.perf_counter() - render_start) * 1000
+print(json.dumps(timings))
+"""
+
+# 合成題目用的常用字
+_CHARS = "行銷市場顧客品牌產品價格通路促銷策略消費者定位區隔目標服務價值管理溝通廣告媒體關係忠誠滿意需求購買決策競爭優勢組合數位網路社群內容分析研究調查資料"
+
+
+def _text(rng, low, high):
+    return "".join(rng.choice(_CHARS) for _ in range(rng.randint(low, high)))
+
+
+def make_workbook(path, num_questions, seed=0):
+    """Writes a synthetic 題庫總表 workbook spread evenly over the CH1-CH9 sections."""
+    rng = random.Random(seed)
+    sections = [s for secs in CHAPTER_MAPPING.values() for s in secs]
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(SHEET_NAME)
+    ws.append(["章節", "題號", "題目", "A", "B", "C", "D", "亂數", "解答", "解析"])
+    per_section = -(-num_questions // len(sections))
+    written = 0
+    for section in sections:
+        for number in range(1, per_section + 1):
+            if written == num_questions:
+                break
+            ws.append([section, number, _text(rng, 15, 40)] + [_text(rng, 4, 15) for _ in range(4)]
+                      + [rng.random(), rng.choice("ABCD"), _text(rng, 20, 60)])
+            written += 1
+    wb.save(path)
+
+
+def make_logs(workdir, frame, num_users, entries_per_user, seed=0):
+    """Writes a synthetic wrong-answer log (SQLite) and stats log (CSV) for many users."""
+    rng = np.random.default_rng(seed)
+    store = wrong_log.open_wrong_log(os.path.join(workdir, "錯題紀錄.db"))
+    sections = frame["章節"].astype(str).to_numpy()
+    numbers = frame["題號"].astype(str).to_numpy()
+    stamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with open(os.path.join(workdir, "答題統計.csv"), "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(stats_log.STATS_COLUMNS)
+        for u in range(num_users):
+            user = f"user{u}"
+            rows = rng.choice(len(frame), size=min(entries_per_user, len(frame)), replace=False)
+            store.add([{"使用者": user, "時間": stamp, "章節": sections[r], "題號": numbers[r], "使用者答案": "A"} for r in rows])
+            writer.writerows([user, stamp, sections[r], numbers[r], "A", False, 5.0] for r in rows)
+
+
+def measure(func, repeat):
+    """Runs func repeat times and returns the timings in milliseconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+class Recorder:
+    def __init__(self):
+        self.results = {}
+
+    def add(self, name, size, timings):
+        key = f"{name}[{size}]"
+        self.results[key] = {"median_ms": statistics.median(timings), "min_ms": min(timings), "runs": len(timings)}
+        print(f"{key:<45} median {self.results[key]['median_ms']:10.3f} ms  (min {min(timings):.3f}, n={len(timings)})")
+
+    def time(self, name, size, func, repeat):
+        self.add(name, size, measure(func, repeat))
+
+
+def bench_modules(rec, size, workdir, repeat):
+    """Times the bank, index, search and log modules directly."""
+    excel_path = os.path.join(workdir, EXCEL_NAME)
+
+    def cold_load():
+        shutil.rmtree(os.path.join(workdir, bank.SNAPSHOT_DIR), ignore_errors=True)
+        bank.load_question_frame(excel_path, SHEET_NAME)
+
+    rec.time("load_data.cold_xlsx", size, cold_load, 1)
+    rec.time("load_data.snapshot", size, lambda: bank.load_question_frame(excel_path, SHEET_NAME), repeat)
+    frame = bank.load_question_frame(excel_path, SHEET_NAME)
+
+    rec.time("bank_index.build", size, lambda: bank.BankIndex(frame, CHAPTER_MAPPING), max(1, repeat // 5))
+    index = bank.BankIndex(frame, CHAPTER_MAPPING)
+    rng = np.random.default_rng(0)
+    for n in (5, 50):
+        rec.time(f"generate.normal.n{n}", size, lambda: frame.iloc[bank.sample_rows(index.chapter_rows(["CH1", "CH5", "CH9"]), n, rng)], repeat)
+
+    store = wrong_log.open_wrong_log(os.path.join(workdir, "錯題紀錄.db"))
+    wrong_index = wrong_log.WrongQuestionIndex(store, index.positions)
+    rec.time("wrong_index.warm", size, lambda: wrong_log.WrongQuestionIndex(store, index.positions).drill_rows("user0", rng=rng), 1)
+    rec.time("generate.drill.n20", size, lambda: index.valid_rows(wrong_index.drill_rows("user0", rng=rng))[:20], repeat)
+    entries = [{"使用者": "bench", "章節": str(frame["章節"].iloc[r]), "題號": str(frame["題號"].iloc[r])} for r in range(10)]
+    rec.time("wrong_log.add_10", size, lambda: wrong_index.add(entries), repeat)
+
+    build_repeat = 1 if len(frame) > 10_000 else 3
+    rec.time("search.build", size, lambda: search_index.SearchIndex(frame), build_repeat)
+    search = search_index.SearchIndex(frame)
+    rec.time("search.query", size, lambda: search.search("品牌策略"), repeat)
+    overlay = bank.EditOverlay(excel_path, SHEET_NAME)
+    rec.time("edit.set", size, lambda: overlay.set(("1-1", "1"), {"解析": "benchmark"}, frame, index), repeat)
+    os.remove(overlay.path)
+
+
+def bench_app(rec, size, workdir, repeat):
+    """Times full script reruns of app.py through AppTest."""
+    import streamlit as st
+    from streamlit.testing.v1 import AppTest
+
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        def new_app():
+            at = AppTest.from_file(APP_PATH, default_timeout=600)
+            return at
+
+        def cold_start():
+            st.cache_resource.clear()
+            st.cache_data.clear()
+            new_app().run()
+
+        rec.time("app.first_render_cold_cache", size, cold_start, 1)
+        rec.time("app.first_render", size, lambda: new_app().run(), repeat)
+
+        for n in (5, 20, 50):
+            at = new_app().run()
+            at.sidebar.text_input(key="username_input").input("user0").run()
+            at.sidebar.multiselect(key="chapters_select").set_value(list(CHAPTER_MAPPING)).run()
+            at.sidebar.number_input(key="num_questions_input").set_value(n).run()
+            rec.time(f"app.start_quiz.normal.n{n}", size, lambda: at.sidebar.button(key="start_quiz_button").click().run(), repeat)
+            rec.time(f"app.render_loop.n{n}", size, lambda: at.run(), repeat)
+
+        def answer_all(at):
+            timings = []
+            while True:
+                radios = [r for r in at.main.radio if r.key.startswith("q") and not r.disabled]
+                if not radios:
+                    return timings
+                start = time.perf_counter()
+                radios[0].set_value(radios[0].options[0]).run()
+                timings.append((time.perf_counter() - start) * 1000)
+
+        completion = []
+        for _ in range(repeat):
+            at = new_app().run()
+            at.sidebar.text_input(key="username_input").input("bench_user").run()
+            at.sidebar.button(key="start_quiz_button").click().run()
+            # The last rerun completes the quiz and writes the wrong log
+            completion.append(answer_all(at)[-1])
+        rec.add("app.complete_quiz.n5", size, completion)
+
+        at = new_app().run()
+        at.sidebar.text_input(key="username_input").input("user0").run()
+        at.sidebar.radio(key="quiz_mode_radio").set_value("錯題再練模式").run()
+        at.sidebar.multiselect(key="chapters_select").set_value(list(CHAPTER_MAPPING)).run()
+        rec.time("app.start_quiz.wrong.n5", size, lambda: at.sidebar.button(key="start_quiz_button").click().run(), repeat)
+
+        at = new_app().run()
+        at.sidebar.checkbox(key="admin_mode_checkbox").check().run()
+        at.text_input(key="admin_pwd_input").input("quiz2024").run()
+        keywords = ["品牌", "市場區隔", "顧客價值", "促銷策略"]
+        rec.time("app.admin_search", size, lambda: at.text_input(key="edit_keyword").input(random.choice(keywords)).run(), repeat)
+        at.text_input(key="edit_keyword").input("").run() # Every question, so there is one to edit
+        at.text_input(key="edit_A").input("benchmark option").run()
+        rec.time("app.admin_update", size, lambda: at.button(key="update_question_button").click().run(), repeat)
+    finally:
+        # Release the cached stores and stop the stats writer while the work directory still exists
+        st.cache_resource.clear()
+        os.chdir(cwd)
+
+
+def app_imports():
+    """Returns the top-level import statements of app.py, which every cold start executes."""
+    with open(APP_PATH, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    return "\n".join(ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom)))
+
+
+def bench_startup(rec, size, workdir, repeat):
+    """Times the app.py imports and the first render in fresh processes, with and without prewarm."""
+
+    def run(render, prewarm):
+        script = _STARTUP_SCRIPT.format(repo=REPO_ROOT, imports=app_imports(), render=render, prewarm=prewarm, app=APP_PATH)
+        out = subprocess.run([sys.executable, "-c", script], cwd=workdir, capture_output=True, text=True, check=True)
+        return json.loads(out.stdout.strip().splitlines()[-1])
+
+    imports, cold, prewarmed = [], [], []
+    for _ in range(repeat):
+        imports.append(run(False, False)["import"])
+        timings = run(True, False)
+        # Time to first render as a user sees it: the imports plus the first script run
+        cold.append(timings["import"] + timings["render"])
+        prewarmed.append(run(True, True)["render"])
+    rec.add("startup.import", size, imports)
+    rec.add("startup.first_render", size, cold)
+    rec.add("startup.first_render_prewarmed", size, prewarmed)
+
+
+def over_budget(results, budgets):
+    """Returns the startup benchmarks whose median exceeds their budget."""
+    return [(name, budgets[name], result["median_ms"]) for name, result in results.items()
+            if name in budgets and result["median_ms"] > budgets[name]]
+
+
+def compare(results, baseline, threshold):
+    """Returns the benchmarks slower than the baseline by more than threshold (a fraction)."""
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base and result["median_ms"] > base["median_ms"] * (1 + threshold):
+            regressions.append((name, base["median_ms"], result["median_ms"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="1k,10k", help="comma-separated bank sizes: " + ", ".join(SIZES))
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark (median is reported)")
+    parser.add_argument("--users", type=int, default=500, help="users in the synthetic logs")
+    parser.add_argument("--entries-per-user", type=int, default=40, help="wrong answers per synthetic user")
+    parser.add_argument("--skip-app", action="store_true", help="only time the modules, not AppTest reruns")
+    parser.add_argument("--skip-startup", action="store_true", help="do not time startup in fresh processes")
+    parser.add_argument("--output", default=RESULTS_PATH, help="where to write the JSON results")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed slowdown before failing (0.25 = 25%%)")
+    parser.add_argument("--save-baseline", action="store_true", help="write the results to the baseline file")
+    parser.add_argument("--keep", action="store_true", help="keep the synthetic work directories")
+    args = parser.parse_args(argv)
+
+    rec = Recorder()
+    for size in args.sizes.split(","):
+        size = size.strip().lower()
+        workdir = tempfile.mkdtemp(prefix=f"quiz-bench-{size}-")
+        try:
+            print(f"== {size}: generating synthetic bank in {workdir}")
+            make_workbook(os.path.join(workdir, EXCEL_NAME), SIZES[size])
+            make_logs(workdir, bank.load_question_frame(os.path.join(workdir, EXCEL_NAME), SHEET_NAME), args.users, args.entries_per_user)
+            bench_modules(rec, size, workdir, args.repeat)
+            if not args.skip_app:
+                bench_app(rec, size, workdir, args.repeat)
+            if not args.skip_startup:
+                bench_startup(rec, size, workdir, args.repeat)
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {"time": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(), "machine": platform.machine()},
+        "results": rec.results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Results written to {args.output}")
+
+    over = over_budget(rec.results, STARTUP_BUDGET_MS)
+    for name, budget, median in over:
+        print(f"OVER BUDGET {name}: {median:.3f} ms > {budget} ms")
+
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+        return 1 if over else 0
+
+    if not os.path.exists(args.baseline):
+        print("No baseline to compare against (run with --save-baseline to store one).")
+        return 1 if over else 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(rec.results, baseline, args.threshold)
+    for name, before, after in regressions:
+        print(f"REGRESSION {name}: {before:.3f} ms -> {after:.3f} ms")
+    return 1 if regressions or over else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+"""Near-duplicate question detection (相似題目) with MinHash signatures and LSH banding."""
+import re
+
+import numpy as np
+import pandas as pd
+
+import bank
+
+# 比對欄位：題目與四個選項 (各自切成字元片段，選項順序不影響結果)
+DUPLICATE_FIELDS = ["題目", "A", "B", "C", "D"]
+
+SHINGLE_SIZE = 3
+
+# LSH 分段：BANDS 段，每段 ROWS_PER_BAND 個 MinHash 值
+BANDS = 16
+ROWS_PER_BAND = 4
+NUM_HASHES = BANDS * ROWS_PER_BAND
+
+# 估計的 Jaccard 相似度達此值才視為相似題目
+DUPLICATE_THRESHOLD = 0.6
+
+REPORT_COLUMNS = ["群組", "列", "章節", "題號", "題目", "相似度"]
+
+_MIX = np.uint64(0x9E3779B97F4A7C15)
+
+_NOISE = re.compile(r"[\W_]+") # Spaces and punctuation (Python's \W keeps CJK characters)
+
+
+def _shingles(frame):
+    """Returns the row and the 32-bit hash of every character shingle of the compared fields.
+
+    Each field is lower-cased and stripped of spaces and punctuation, then all fields of all rows
+    are joined into one string with NUL separators, so the shingles are cut with array operations
+    over its code points. Windows that cross a separator are dropped.
+    """
+    columns = [column for column in DUPLICATE_FIELDS if column in frame.columns]
+    if not columns or frame.empty:
+        return bank.EMPTY_ROWS, np.empty(0, dtype=np.uint32)
+    # Row-major: the fields of row 0, then those of row 1, ...
+    texts = [_NOISE.sub("", str(value).lower()) for value in frame[columns].to_numpy(dtype=object).ravel()]
+    codes = np.frombuffer(("\0".join(texts) + "\0").encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    lengths = np.fromiter((len(t) + 1 for t in texts), dtype=np.int64, count=len(texts))
+    text_rows = np.repeat(np.arange(len(texts)) // len(columns), lengths)
+
+    k = SHINGLE_SIZE
+    windows = len(codes) - k + 1
+    if windows <= 0:
+        return bank.EMPTY_ROWS, np.empty(0, dtype=np.uint32)
+    separator = codes == 0
+    valid = ~np.logical_or.reduce([separator[i:i + windows] for i in range(k)])
+    hashes = np.zeros(windows, dtype=np.uint64)
+    for i in range(k):
+        hashes = (hashes ^ codes[i:i + windows]) * _MIX
+    return text_rows[:windows][valid].astype(np.int32), (hashes[valid] >> np.uint64(32)).astype(np.uint32)
+
+
+def minhash_signatures(frame, seed=0):
+    """Returns (NUM_HASHES MinHash values per row, mask of rows with at least one shingle).
+
+    Each hash function is a random odd multiplier and xor key followed by an xor-shift over
+    uint32; the per-row minimum of every function is taken with one reduceat over the shingles.
+    """
+    rows, hashes = _shingles(frame)
+    signatures = np.full((len(frame), NUM_HASHES), np.iinfo(np.uint32).max, dtype=np.uint32)
+    has_shingles = np.zeros(len(frame), dtype=bool)
+    if not len(rows):
+        return signatures, has_shingles
+    rng = np.random.default_rng(seed)
+    multipliers = rng.integers(0, 2 ** 32, NUM_HASHES, dtype=np.uint32) | np.uint32(1)
+    keys = rng.integers(0, 2 ** 32, NUM_HASHES, dtype=np.uint32)
+    # Shingles are already grouped by row, so each row is one reduceat segment
+    starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    owners = rows[starts]
+    for i in range(NUM_HASHES):
+        values = (hashes ^ keys[i]) * multipliers[i]
+        values ^= values >> np.uint32(16)
+        signatures[owners, i] = np.minimum.reduceat(values, starts)
+    has_shingles[owners] = True
+    return signatures, has_shingles
+
+
+def _find(parent, i):
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+class DuplicateIndex:
+    """Clusters of near-duplicate questions, found from MinHash signatures in near-linear time.
+
+    The signatures are split into BANDS bands; rows whose band values collide in any band are
+    candidates. Each candidate is compared with the first row of its bucket, and pairs whose
+    signatures agree on at least `threshold` of the hashes are merged into one cluster. No pair of
+    questions is compared unless LSH put them in the same bucket.
+    """
+
+    def __init__(self, frame, threshold=DUPLICATE_THRESHOLD):
+        self.threshold = threshold
+        self.signatures, has_shingles = minhash_signatures(frame)
+        candidates = np.flatnonzero(has_shingles)
+        # Cluster ids are numbered 0.. in order of their first row; -1 means no near-duplicate
+        self.clusters = np.full(len(frame), -1, dtype=np.int32)
+        if not len(candidates):
+            return # Empty bank, or no comparable text
+        pairs = []
+        for band in range(BANDS):
+            block = self.signatures[candidates, band * ROWS_PER_BAND:(band + 1) * ROWS_PER_BAND].astype(np.uint64)
+            bucket = np.zeros(len(candidates), dtype=np.uint64)
+            for column in block.T:
+                bucket = (bucket ^ column) * _MIX
+            order = np.argsort(bucket, kind="stable")
+            sorted_buckets = bucket[order]
+            first = np.r_[True, sorted_buckets[1:] != sorted_buckets[:-1]]
+            # Pair every bucket member with the bucket's first member
+            heads = order[np.maximum.accumulate(np.where(first, np.arange(len(order)), 0))]
+            members = ~first
+            pairs.append(np.column_stack([candidates[heads[members]], candidates[order[members]]]))
+        pairs = np.unique(np.concatenate(pairs), axis=0) if pairs else np.empty((0, 2), dtype=np.int64)
+        if len(pairs):
+            agreement = (self.signatures[pairs[:, 0]] == self.signatures[pairs[:, 1]]).mean(axis=1)
+            pairs = pairs[agreement >= threshold]
+
+        parent = np.arange(len(frame))
+        for a, b in pairs.tolist():
+            root_a, root_b = _find(parent, a), _find(parent, b)
+            if root_a != root_b:
+                parent[max(root_a, root_b)] = min(root_a, root_b)
+        roots = np.array([_find(parent, i) for i in range(len(frame))], dtype=np.int64)
+        sizes = np.bincount(roots, minlength=len(frame))
+        in_cluster = sizes[roots] > 1
+        _, self.clusters[in_cluster] = np.unique(roots[in_cluster], return_inverse=True)
+
+    @property
+    def cluster_count(self):
+        return int(self.clusters.max()) + 1 if len(self.clusters) else 0
+
+    def report(self, frame):
+        """Returns one row per clustered question with its estimated similarity to the cluster's first question."""
+        rows = np.flatnonzero(self.clusters >= 0)
+        if not len(rows):
+            return pd.DataFrame(columns=REPORT_COLUMNS)
+        rows = rows[np.lexsort((rows, self.clusters[rows]))]
+        clusters = self.clusters[rows]
+        first = np.r_[True, clusters[1:] != clusters[:-1]]
+        heads = rows[first][np.cumsum(first) - 1]
+        similarity = (self.signatures[rows] == self.signatures[heads]).mean(axis=1)
+        report = frame[["章節", "題號", "題目"]].iloc[rows].reset_index(drop=True)
+        report.insert(0, "群組", clusters + 1)
+        report.insert(1, "列", rows + 2) # Spreadsheet row number (1-based, after the header)
+        report["相似度"] = np.round(similarity, 2)
+        return report
+
+    def first_distinct(self, rows):
+        """Returns the rows without those whose near-duplicate cluster already appeared earlier, in order."""
+        rows = np.asarray(rows, dtype=np.int32)
+        # Questions outside any cluster get a group of their own
+        groups = np.where(self.clusters[rows] >= 0, self.clusters[rows], len(self.clusters) + rows.astype(np.int64))
+        _, first = np.unique(groups, return_index=True)
+        return rows[np.sort(first)]
+
+    def sample_rows(self, row_arrays, num_questions, rng):
+        """Like bank.sample_rows, but keeps at most one question of each near-duplicate cluster.
+
+        Draws more rows (doubling) until num_questions distinct clusters are found or the pool is used up.
+        """
+        total = sum(len(rows) for rows in row_arrays)
+        draw = num_questions
+        while True:
+            # Keep the draw order, which is already random
+            kept = self.first_distinct(bank.sample_rows(row_arrays, min(draw, total), rng))
+            if len(kept) >= num_questions or draw >= total:
+                return kept[:num_questions]
+            draw *= 2
@@ -0,0 +1,252 @@
+"""Command-line generator of exam papers (試卷) and answer keys (解答) from the question bank.
+
+Usage (from the repository root):
+
+    python exam_papers.py --students 500 --chapters CH1 CH2 --num-questions 40
+    python exam_papers.py --students 500 --papers-per-student 3 --quota CH1=5 --quota CH2=5 --format xlsx
+
+Papers are drawn with the same derived chapters and row index as the quiz's 一般出題模式. Every
+paper gets its own option order, and its answer key lists the label shown on that paper. The
+students are split into fixed chunks that a process pool generates in parallel. Each chunk's
+generator is seeded from (--seed, chunk number), so the same seed and settings always give the
+same papers whatever --workers is. A student's papers never repeat a question. Questions that
+fail the bank check (bank.find_issues) are never drawn.
+
+CSV output is one 試卷.csv and one 解答.csv, concatenated in order from the per-chunk part files.
+xlsx output is one write-only workbook per chunk, because a sheet holds at most 1,048,576 rows.
+"""
+import argparse
+import csv
+import os
+import secrets
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from openpyxl import Workbook
+
+import bank
+import quiz
+
+EXCEL_PATH = "行銷題庫總表.xlsx"
+SHEET_NAME = "題庫總表"
+
+# 每個工作單位的學生數；亂數種子依單位編號衍生，因此結果與行程數無關
+CHUNK_STUDENTS = 500
+
+PAPER_COLUMNS = ["試卷編號", "學生編號", "題序", "章節", "題號", "題目", "A", "B", "C", "D"]
+ANSWER_COLUMNS = ["試卷編號", "學生編號", "題序", "章節", "題號", "答案", "解析"]
+
+_worker = None # Per-process generator state, set by _init_worker
+
+
+def answer_codes(frame):
+    """Returns the index (0-3) of each row's correct option, or -1 where 解答 is not A-D."""
+    return frame["解答"].map({label: i for i, label in enumerate(quiz.LABELS)}).fillna(-1).to_numpy(dtype=np.int8)
+
+
+def parse_quotas(items):
+    """Parses "CH1=5" or "CH1=5,CH2=3" items into [(chapter, count)]."""
+    quotas = []
+    for item in items or []:
+        for part in item.split(","):
+            chapter, sep, count = part.partition("=")
+            if not sep or not count.strip().isdigit():
+                raise ValueError(f"配額格式錯誤：{part}（應為 CH1=5）")
+            quotas.append((chapter.strip(), int(count)))
+    return quotas
+
+
+def build_plan(index, chapters, num_questions, quotas, papers_per_student):
+    """Returns the draws making up one paper as (label, row pool, count) tuples.
+
+    With quotas each chapter is drawn separately; otherwise num_questions come from the selected
+    chapters together, as in the quiz. Raises ValueError if a pool cannot give every paper of a
+    student distinct questions.
+    """
+    if quotas:
+        unknown = [ch for ch, _ in quotas if ch not in index.chapters]
+        if unknown:
+            raise ValueError(f"未知的章節：{', '.join(unknown)}")
+        draws = [(ch, index.chapters[ch], n) for ch, n in quotas]
+    else:
+        pools = index.chapter_rows(chapters)
+        draws = [("+".join(chapters), np.concatenate(pools) if pools else bank.EMPTY_ROWS, num_questions)]
+
+    plan = []
+    for label, pool, n in draws:
+        if n * papers_per_student > len(pool):
+            raise ValueError(f"{label} 只有 {len(pool)} 題有效題目，不足以讓每位學生的 {papers_per_student} 份試卷各抽 {n} 題且不重複")
+        plan.append((label, pool, n))
+    return plan
+
+
+class _Generator:
+    """Bank columns and settings a worker process needs to write its chunks."""
+
+    def __init__(self, excel_path, sheet_name, plan, students, papers_per_student, seed, fmt, output_dir):
+        frame = bank.load_question_frame(excel_path, sheet_name) # The snapshot is memory-mapped, not re-parsed
+        self.sections = frame["章節"].to_numpy()
+        self.numbers = frame["題號"].to_numpy()
+        self.questions = frame["題目"].to_numpy()
+        self.explanations = frame["解析"].to_numpy()
+        self.options = frame[list(quiz.LABELS)].to_numpy()
+        self.codes = answer_codes(frame)
+        self.plan = plan
+        self.students = students
+        self.papers_per_student = papers_per_student
+        self.seed = seed
+        self.fmt = fmt
+        self.output_dir = output_dir
+
+    def draw(self, chunk):
+        """Returns the first student number, the (papers, questions) rows and their option orders for a chunk."""
+        first = chunk * CHUNK_STUDENTS
+        students = min(CHUNK_STUDENTS, self.students - first)
+        k = self.papers_per_student
+        rng = np.random.default_rng([self.seed, chunk])
+        # One draw of k * n questions per student, split into k papers, keeps a student's papers disjoint
+        rows = np.concatenate(
+            [bank.sample_row_batches(pool, n * k, students, rng).reshape(students * k, n) for _, pool, n in self.plan],
+            axis=1
+        )
+        orders = np.argsort(rng.random(rows.shape + (len(quiz.LABELS),)), axis=-1)
+        return first, rows, orders
+
+    def tables(self, chunk):
+        """Returns the paper and answer-key rows of a chunk as two lists of tuples."""
+        first, rows, orders = self.draw(chunk)
+        papers, questions = rows.shape
+        k = self.papers_per_student
+        paper_ids = np.repeat(np.arange(first * k + 1, first * k + papers + 1), questions)
+        student_ids = (paper_ids - 1) // k + 1
+        seq = np.tile(np.arange(1, questions + 1), papers)
+        flat = rows.ravel()
+        flat_orders = orders.reshape(-1, len(quiz.LABELS))
+        options = self.options[flat[:, None], flat_orders]
+        # The answer is the display position holding the original correct option
+        answers = np.array(quiz.LABELS)[np.argmax(flat_orders == self.codes[flat][:, None], axis=1)]
+        sections, numbers = self.sections[flat], self.numbers[flat]
+        paper_rows = list(zip(
+            paper_ids.tolist(), student_ids.tolist(), seq.tolist(), sections, numbers, self.questions[flat],
+            options[:, 0], options[:, 1], options[:, 2], options[:, 3]
+        ))
+        answer_rows = list(zip(
+            paper_ids.tolist(), student_ids.tolist(), seq.tolist(), sections, numbers, answers.tolist(), self.explanations[flat]
+        ))
+        return paper_rows, answer_rows
+
+    def write(self, chunk):
+        """Writes one chunk (CSV part files or one workbook). Returns the paths written."""
+        paper_rows, answer_rows = self.tables(chunk)
+        if self.fmt == "xlsx":
+            path = os.path.join(self.output_dir, f"試卷_{chunk + 1:04d}.xlsx")
+            wb = Workbook(write_only=True)
+            for title, columns, rows in (("試卷", PAPER_COLUMNS, paper_rows), ("解答", ANSWER_COLUMNS, answer_rows)):
+                ws = wb.create_sheet(title)
+                ws.append(columns)
+                for row in rows:
+                    ws.append(row)
+            wb.save(path)
+            return [path]
+
+        paths = []
+        for name, rows in (("試卷", paper_rows), ("解答", answer_rows)):
+            path = os.path.join(self.output_dir, f".{name}_{chunk:05d}.part")
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                csv.writer(f).writerows(rows)
+            paths.append(path)
+        return paths
+
+
+def _init_worker(*args):
+    global _worker
+    _worker = _Generator(*args)
+
+
+def _write_chunk(chunk):
+    return _worker.write(chunk)
+
+
+def generate(excel_path, sheet_name, output_dir, students, papers_per_student=1, chapters=("CH1",), num_questions=50,
+             quotas=None, seed=None, fmt="csv", workers=None):
+    """Generates the papers and answer keys into output_dir. Returns (papers, questions per paper, seed)."""
+    seed = secrets.randbits(63) if seed is None else seed
+    frame = bank.load_question_frame(excel_path, sheet_name) # Also compiles the snapshot the workers map
+    index = bank.BankIndex(frame)
+    plan = build_plan(index, list(chapters), num_questions, quotas, papers_per_student)
+    os.makedirs(output_dir, exist_ok=True)
+
+    chunks = range((students + CHUNK_STUDENTS - 1) // CHUNK_STUDENTS)
+    init_args = (excel_path, sheet_name, plan, students, papers_per_student, seed, fmt, output_dir)
+    if workers == 1:
+        _init_worker(*init_args)
+        results = map(_write_chunk, chunks)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=init_args)
+        results = executor.map(_write_chunk, chunks)
+
+    try:
+        if fmt == "xlsx":
+            for _ in results:
+                pass
+        else:
+            # Parts arrive in chunk order and are appended as they come, so the output streams to disk
+            with open(os.path.join(output_dir, "試卷.csv"), "w", newline="", encoding="utf-8-sig") as papers_file, \
+                 open(os.path.join(output_dir, "解答.csv"), "w", newline="", encoding="utf-8-sig") as answers_file:
+                csv.writer(papers_file).writerow(PAPER_COLUMNS)
+                csv.writer(answers_file).writerow(ANSWER_COLUMNS)
+                for target, path in ((t, p) for parts in results for t, p in zip((papers_file, answers_file), parts)):
+                    target.flush()
+                    with open(path, "rb") as part:
+                        shutil.copyfileobj(part, target.buffer)
+                    os.remove(path)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return students * papers_per_student, sum(n for _, _, n in plan), seed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--students", type=int, required=True, help="number of students")
+    parser.add_argument("--papers-per-student", type=int, default=1, help="papers per student (no question repeats across them)")
+    parser.add_argument("--chapters", nargs="+", default=["CH1"], help="chapters to draw from, e.g. CH1 CH2")
+    parser.add_argument("--num-questions", type=int, default=50, help="questions per paper (ignored with --quota)")
+    parser.add_argument("--quota", action="append", help="questions per chapter, e.g. CH1=5 or CH1=5,CH2=3 (repeatable)")
+    parser.add_argument("--seed", type=int, help="seed for reproducible papers (random if omitted)")
+    parser.add_argument("--format", choices=["csv", "xlsx"], default="csv", help="output format")
+    parser.add_argument("--output", default="試卷輸出", help="output directory")
+    parser.add_argument("--workers", type=int, help="worker processes (default: CPU count; 1 runs in-process)")
+    parser.add_argument("--excel", default=EXCEL_PATH, help="question bank workbook")
+    parser.add_argument("--sheet", default=SHEET_NAME, help="question bank sheet")
+    args = parser.parse_args(argv)
+
+    if args.students < 1 or args.papers_per_student < 1 or args.num_questions < 1:
+        parser.error("--students、--papers-per-student 與 --num-questions 必須為正整數")
+    try:
+        quotas = parse_quotas(args.quota)
+    except ValueError as e:
+        parser.error(str(e))
+
+    start = time.perf_counter()
+    try:
+        papers, questions, seed = generate(
+            args.excel, args.sheet, args.output, args.students, args.papers_per_student, args.chapters,
+            args.num_questions, quotas, args.seed, args.format, args.workers
+        )
+    except (FileNotFoundError, ValueError) as e:
+        print(f"錯誤：{e}", file=sys.stderr)
+        return 1
+    elapsed = time.perf_counter() - start
+    print(f"已產生 {papers} 份試卷（每份 {questions} 題），輸出至 {args.output}，"
+          f"耗時 {elapsed:.1f} 秒（每分鐘約 {papers / elapsed * 60:,.0f} 份），種子 {seed}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,136 @@
+"""Bulk grading (批次閱卷) of uploaded answer sheets against the question bank."""
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import quiz
+import wrong_log
+
+# 答案卡必要欄位 (另可附「時間」欄位)
+SHEET_COLUMNS = ["使用者", "章節", "題號", "使用者答案"]
+
+# 無法評分的原因
+STATUS_UNKNOWN_QUESTION = "找不到題目"
+STATUS_QUARANTINED = "題目已隔離 (未通過題庫檢查)"
+STATUS_NO_USER = "缺少使用者名稱"
+
+_LABEL_INDEX = {label: i for i, label in enumerate(quiz.LABELS)}
+
+
+def read_sheets(file):
+    """Reads an answer-sheet CSV with every column as text. Raises ValueError if a required column is missing."""
+    sheets = pd.read_csv(file, dtype=str, keep_default_na=False, encoding="utf-8-sig")
+    sheets.columns = sheets.columns.str.strip()
+    missing = [c for c in SHEET_COLUMNS if c not in sheets.columns]
+    if missing:
+        raise ValueError(f"答案卡缺少欄位：{', '.join(missing)}")
+    return sheets
+
+
+def _labels(values):
+    return values.astype(str).str.strip().str.upper()
+
+
+class GradeResult:
+    """Answer sheets joined to the bank in one pass, with per-user scores and per-question error rates.
+
+    Every sheet row is matched to its bank row through the (章節, 題號) key index, and the chosen
+    label is compared with the bank's 解答 as whole columns; no per-answer Python loop is involved.
+    Users are matched the way the wrong log matches them (wrong_log.user_key, case-insensitive);
+    rows without a username are not graded.
+    """
+
+    def __init__(self, sheets, frame, index):
+        self.sheets = sheets.reset_index(drop=True)
+        self.usernames = self.sheets["使用者"].astype(str).str.strip().to_numpy()
+        self.user_keys = self.sheets["使用者"].astype(str).str.strip().str.lower().to_numpy() # Vectorized wrong_log.user_key
+        sections = self.sheets["章節"].astype(str).str.strip()
+        # Spreadsheet exports often write 題號 5 as "5.0"
+        numbers = self.sheets["題號"].astype(str).str.strip().str.replace(r"\.0$", "", regex=True)
+        lookup = pd.Index([f"{s}\x1f{n}" for s, n in index.positions])
+        bank_rows = np.fromiter(index.positions.values(), dtype=np.int64, count=len(index.positions))
+        found = lookup.get_indexer(sections + "\x1f" + numbers) if len(lookup) else np.full(len(self.sheets), -1)
+        self.rows = np.where(found >= 0, bank_rows[found], -1)
+
+        matched = self.rows >= 0
+        correct_labels = np.full(len(self.sheets), "", dtype=object)
+        correct_labels[matched] = frame["解答"].to_numpy()[self.rows[matched]] # Normalized when the bank was loaded
+        self.user_labels = _labels(self.sheets["使用者答案"]).to_numpy()
+        self.correct_labels = correct_labels
+
+        status = np.full(len(self.sheets), "", dtype=object)
+        status[matched] = np.where(index.valid[self.rows[matched]], "", STATUS_QUARANTINED)
+        status[~matched] = STATUS_UNKNOWN_QUESTION
+        status[self.user_keys == ""] = STATUS_NO_USER
+        self.status = status
+        self.graded = status == ""
+        self.correct = self.graded & (self.user_labels == correct_labels)
+
+    @property
+    def skipped(self):
+        """Returns the number of sheet rows that could not be graded."""
+        return int((~self.graded).sum())
+
+    def skipped_rows(self):
+        """Returns the sheet rows that could not be graded, with the reason."""
+        return self.sheets[~self.graded].assign(原因=self.status[~self.graded])
+
+    def scores(self):
+        """Returns one row per user (case-insensitive, shown as first written): answered, correct and the score in percent."""
+        graded = pd.DataFrame({
+            "key": self.user_keys[self.graded], "使用者": self.usernames[self.graded], "答對": self.correct[self.graded]
+        })
+        scores = graded.groupby("key", sort=False).agg(使用者=("使用者", "first"), 作答題數=("答對", "size"), 答對題數=("答對", "sum"))
+        scores = scores.sort_values("使用者", ignore_index=True)
+        scores["得分"] = (scores["答對題數"] / scores["作答題數"] * 100).round(1)
+        return scores
+
+    def question_stats(self, frame):
+        """Returns one row per graded question with its attempts and error rate, worst first."""
+        graded = pd.DataFrame({"row": self.rows[self.graded], "答錯": ~self.correct[self.graded]})
+        stats = graded.groupby("row")["答錯"].agg(作答人次="size", 答錯人次="sum")
+        stats["錯誤率"] = (stats["答錯人次"] / stats["作答人次"]).round(3)
+        info = frame[["章節", "題號", "題目"]].iloc[stats.index].reset_index(drop=True)
+        stats = pd.concat([info, stats.reset_index(drop=True)], axis=1)
+        return stats.sort_values(["錯誤率", "作答人次"], ascending=False, ignore_index=True)
+
+    def wrong_entries(self, frame, answered_at=None):
+        """Returns the wrong answers as wrong-log entries, one per (user, question)."""
+        wrong = np.flatnonzero(self.graded & ~self.correct)
+        users = self.usernames[wrong]
+        rows = self.rows[wrong]
+        keep = ~pd.DataFrame({"u": self.user_keys[wrong], "r": rows}).duplicated().to_numpy()
+        wrong, users, rows = wrong[keep], users[keep], rows[keep]
+        if not len(wrong):
+            return []
+
+        # Look the text up once per distinct question, then spread it over the wrong answers
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        records = frame.iloc[unique_rows]
+        # A fifth, empty column stands for labels outside A-D
+        options = np.column_stack([records[list(quiz.LABELS)].to_numpy(), np.full(len(records), "")])
+        user_labels = self.user_labels[wrong]
+        correct_labels = self.correct_labels[wrong]
+        if "時間" in self.sheets.columns:
+            times = self.sheets["時間"].to_numpy()[wrong]
+        else:
+            times = np.full(len(wrong), (answered_at or datetime.now()).strftime("%Y-%m-%d %H:%M:%S"), dtype=object)
+
+        def chosen(labels):
+            return options[inverse, pd.Series(labels).map(_LABEL_INDEX).fillna(len(quiz.LABELS)).astype(int).to_numpy()]
+
+        columns = [
+            users,
+            times,
+            records["章節"].to_numpy()[inverse],
+            records["題號"].to_numpy()[inverse],
+            records["題目"].to_numpy()[inverse],
+            user_labels,
+            chosen(user_labels),
+            correct_labels,
+            chosen(correct_labels),
+            records["解析"].to_numpy()[inverse],
+        ]
+        # Zipping plain lists is several times faster than DataFrame.to_dict on Arrow-backed strings
+        return [dict(zip(wrong_log.WRONG_LOG_COLUMNS, values)) for values in zip(*(c.tolist() for c in columns))]
@@ -0,0 +1,187 @@
+"""Lightweight timing spans and cache counters behind the admin 效能監控 panel.
+
+Spans are kept in a bounded ring buffer per name, so memory stays fixed however long the server
+runs. When monitoring is disabled (QUIZ_PERF=0 or set_enabled(False)), span() returns a shared
+no-op context manager and counters return immediately.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# 每個名稱保留的最近樣本數
+RING_SIZE = 2048
+
+_enabled = os.environ.get("QUIZ_PERF", "1") != "0"
+_lock = threading.Lock()
+_samples = {} # span name -> deque of recent durations (seconds)
+_totals = {} # span name -> [count, sum of seconds] since start
+_counters = {} # (counter name, label) -> count
+_last_export = 0.0
+_local = threading.local()
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def stop(self):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def stop(self):
+        observe(self.name, time.perf_counter() - self.start)
+
+
+def enabled():
+    return _enabled
+
+
+def set_enabled(flag):
+    """Turns recording on or off for the whole process."""
+    global _enabled
+    _enabled = bool(flag)
+
+
+def span(name):
+    """Times a block: `with perf.span("name"): ...`, or `s = perf.span("name")` ... `s.stop()`."""
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def mark_miss():
+    """Called inside the body of a cached function: the current cached_call() was a cache miss."""
+    _local.missed = True
+
+
+def cached_call(name, func, *args):
+    """Calls a Streamlit-cached function, timing it and counting a cache hit or miss."""
+    if not _enabled:
+        return func(*args)
+    _local.missed = False
+    with span(name):
+        value = func(*args)
+    count("cache", f"{name}.{'miss' if _local.missed else 'hit'}")
+    return value
+
+
+def observe(name, seconds):
+    """Records one duration for a span name."""
+    if not _enabled:
+        return
+    with _lock:
+        ring = _samples.get(name)
+        if ring is None:
+            ring = _samples[name] = deque(maxlen=RING_SIZE)
+            _totals[name] = [0, 0.0]
+        ring.append(seconds)
+        totals = _totals[name]
+        totals[0] += 1
+        totals[1] += seconds
+
+
+def count(name, label="", n=1):
+    """Increments a counter, e.g. count("cache", "load_data.miss")."""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[(name, label)] = _counters.get((name, label), 0) + n
+
+
+def reset():
+    """Drops every recorded span and counter."""
+    with _lock:
+        _samples.clear()
+        _totals.clear()
+        _counters.clear()
+
+
+def span_summary():
+    """Returns one dict per span name with the count, mean and p50/p95/p99 in milliseconds."""
+    with _lock:
+        snapshot = {name: (np.fromiter(ring, dtype=float), tuple(_totals[name])) for name, ring in _samples.items()}
+    rows = []
+    for name, (recent, (total_count, total_sum)) in sorted(snapshot.items()):
+        p50, p95, p99 = np.percentile(recent, [50, 95, 99]) * 1000
+        rows.append({
+            "名稱": name,
+            "次數": total_count,
+            "平均 (ms)": total_sum / total_count * 1000,
+            "p50 (ms)": p50,
+            "p95 (ms)": p95,
+            "p99 (ms)": p99,
+            "最大 (ms)": recent.max() * 1000,
+        })
+    return rows
+
+
+def counters():
+    """Returns a copy of the counters as {(name, label): count}."""
+    with _lock:
+        return dict(_counters)
+
+
+def prometheus_text():
+    """Renders spans (as summaries) and counters in the Prometheus text exposition format."""
+    lines = [
+        "# HELP quiz_span_seconds Duration of instrumented quiz app code paths.",
+        "# TYPE quiz_span_seconds summary",
+    ]
+    with _lock:
+        snapshot = {name: (np.fromiter(ring, dtype=float), tuple(_totals[name])) for name, ring in _samples.items()}
+        counter_items = sorted(_counters.items())
+    for name, (recent, (total_count, total_sum)) in sorted(snapshot.items()):
+        for q, value in zip(("0.5", "0.95", "0.99"), np.percentile(recent, [50, 95, 99])):
+            lines.append(f'quiz_span_seconds{{span="{name}",quantile="{q}"}} {value:.6f}')
+        lines.append(f'quiz_span_seconds_sum{{span="{name}"}} {total_sum:.6f}')
+        lines.append(f'quiz_span_seconds_count{{span="{name}"}} {total_count}')
+    lines += ["# HELP quiz_events_total Counters of the quiz app (e.g. cache hits and misses).", "# TYPE quiz_events_total counter"]
+    for (name, label), value in counter_items:
+        lines.append(f'quiz_events_total{{name="{name}",label="{label}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def export_prometheus(path):
+    """Writes the metrics to a local file (e.g. for the node_exporter textfile collector)."""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(prometheus_text())
+    os.replace(tmp_path, path)
+
+
+def maybe_export(path, interval=60.0):
+    """Exports the metrics at most once per interval seconds; a no-op when disabled."""
+    global _last_export
+    if not _enabled:
+        return
+    now = time.monotonic()
+    if now - _last_export < interval:
+        return
+    _last_export = now
+    try:
+        export_prometheus(path)
+    except OSError:
+        pass # Metrics are best effort; never fail a page render over them
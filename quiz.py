@@ -0,0 +1,175 @@
+"""Compact per-session quiz state and the question records rendered from it."""
+import json
+import sys
+import zlib
+from datetime import datetime
+
+import numpy as np
+
+LABELS = ("A", "B", "C", "D")
+
+# 單次測驗題數上限 (與側邊欄「出題數量」一致)，確保每個 session 的狀態大小有上限
+MAX_QUIZ_QUESTIONS = 50
+
+
+def keys_digest(frame, rows):
+    """Returns a digest of the (章節, 題號) keys of bank rows, to tell whether row ids still point at the same questions."""
+    keys = frame[["章節", "題號"]].iloc[rows]
+    text = "\x1e".join(f"{section}\x1f{number}" for section, number in zip(keys["章節"].tolist(), keys["題號"].tolist()))
+    return zlib.crc32(text.encode("utf-8"))
+
+
+class QuizQuestion:
+    """One question of a quiz, built on demand from the shared bank for rendering.
+
+    Quizzes only draw validated rows, whose 章節/題號/解答 and option cells are already normalized
+    text (bank.normalize_questions), so nothing is re-checked or converted here.
+    """
+
+    __slots__ = ("position", "row", "key", "section", "number", "text", "choices", "label_of", "correct_label", "correct_text", "explanation")
+
+    def __init__(self, position, row, record, order):
+        self.position = position
+        self.row = row
+        self.section = record["章節"]
+        self.number = record["題號"]
+        self.key = (self.section, self.number)
+        self.text = record["題目"]
+        self.explanation = record.get("解析") or "無解析"
+        options = [record[label] for label in LABELS]
+
+        # choices holds (original label, text) in the display order given by the quiz seed
+        self.choices = tuple((LABELS[j], options[j]) for j in order)
+        self.label_of = {text: label for label, text in self.choices}
+
+        self.correct_label = record["解答"]
+        self.correct_text = options[LABELS.index(self.correct_label)]
+
+    def choice_index(self, label):
+        """Returns the display position of an original label, or None."""
+        for i, (choice_label, _) in enumerate(self.choices):
+            if choice_label == label:
+                return i
+        return None
+
+
+class Answer:
+    """One recorded answer: the bank row, the chosen original label, correctness and time."""
+
+    __slots__ = ("row", "label", "correct", "answered_at")
+
+    def __init__(self, row, label, correct, answered_at):
+        self.row = row
+        self.label = label
+        self.correct = correct
+        self.answered_at = answered_at
+
+
+class QuizState:
+    """Compact quiz state kept per session: bank row ids, one seed and small answer records.
+
+    Display text is never stored here; it is looked up from the shared bank when a question is
+    rendered, and option permutations are derived from the seed.
+    """
+
+    __slots__ = ("rows", "seed", "bank_size", "keys_digest", "checked_key", "drill", "answers", "correct_count", "wrong_logged")
+
+    def __init__(self, rows, seed, frame, drill=False):
+        self.rows = np.asarray(rows, dtype=np.int32)[:MAX_QUIZ_QUESTIONS]
+        self.seed = seed
+        self.drill = drill # 錯題再練: every answer updates the question's review schedule
+        self.bank_size = len(frame)
+        self.keys_digest = keys_digest(frame, self.rows)
+        self.checked_key = None # Cache key of the loaded bank last found to match (not stored)
+        self.answers = {} # row id -> Answer
+        self.correct_count = 0
+        self.wrong_logged = False
+
+    @property
+    def answered_count(self):
+        return len(self.answers)
+
+    def matches(self, frame):
+        """Returns True if the row ids still point at the questions the quiz was drawn from (same size and keys)."""
+        return self.bank_size == len(frame) and keys_digest(frame, self.rows) == self.keys_digest
+
+    def option_order(self, position):
+        """Returns the option permutation of the question at a quiz position."""
+        return np.random.default_rng([self.seed, position]).permutation(len(LABELS))
+
+    def questions(self, frame, start, end):
+        """Builds the QuizQuestion records of quiz positions start..end from the bank."""
+        rows = self.rows[start:end]
+        records = frame.iloc[rows].to_dict("records")
+        return [QuizQuestion(start + i, int(row), record, self.option_order(start + i)) for i, (row, record) in enumerate(zip(rows, records))]
+
+    def record(self, question, label, answered_at):
+        """Records an answer to a question and updates the running counters. Returns correctness."""
+        correct = label == question.correct_label
+        self.answers[question.row] = Answer(question.row, label, correct, answered_at)
+        self.correct_count += correct
+        return correct
+
+    def wrong_entries(self, frame, username):
+        """Returns the wrong answers as wrong-log entries, with their text looked up from the bank."""
+        wrong = [a for a in self.answers.values() if not a.correct]
+        if not wrong:
+            return []
+        entries = []
+        for answer, record in zip(wrong, frame.iloc[[a.row for a in wrong]].to_dict("records")):
+            correct_label = record["解答"]
+            entries.append({
+                "使用者": username,
+                "時間": datetime.fromtimestamp(answer.answered_at).strftime("%Y-%m-%d %H:%M:%S"),
+                "章節": record["章節"],
+                "題號": record["題號"],
+                "題目": record["題目"],
+                "使用者答案": answer.label,
+                "使用者內容": record.get(answer.label, ""),
+                "正確答案": correct_label,
+                "正確內容": record[correct_label],
+                "解析": record.get("解析") or "無解析",
+            })
+        return entries
+
+    def dumps(self):
+        """Returns the state as compact bytes (zlib-compressed JSON) for the session store.
+
+        The store may call this from another session's thread while the owning session records an
+        answer, so the answers are copied in one step before they are iterated.
+        """
+        answers = list(self.answers.values())
+        data = {
+            "rows": self.rows.tolist(),
+            "seed": self.seed,
+            "bank_size": self.bank_size,
+            "keys_digest": self.keys_digest,
+            "drill": self.drill,
+            # Answers in the order they were given: [row, label, correct, answered_at]
+            "answers": [[a.row, a.label, a.correct, a.answered_at] for a in answers],
+            "wrong_logged": self.wrong_logged,
+        }
+        return zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+
+    @classmethod
+    def loads(cls, blob):
+        """Rebuilds a state written by dumps()."""
+        data = json.loads(zlib.decompress(blob))
+        state = cls.__new__(cls)
+        state.rows = np.asarray(data["rows"], dtype=np.int32)
+        state.seed = data["seed"]
+        state.bank_size = data["bank_size"]
+        state.keys_digest = data["keys_digest"]
+        state.checked_key = None # Checked again against whatever bank is loaded now
+        state.drill = data["drill"]
+        state.answers = {row: Answer(row, label, correct, answered_at) for row, label, correct, answered_at in data["answers"]}
+        state.correct_count = sum(a.correct for a in state.answers.values())
+        state.wrong_logged = data["wrong_logged"]
+        return state
+
+    def nbytes(self):
+        """Returns the approximate memory held by this state, in bytes."""
+        return (
+            sys.getsizeof(self) + self.rows.nbytes + sys.getsizeof(self.answers)
+            + sum(sys.getsizeof(a) for a in self.answers.values())
+        )
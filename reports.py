@@ -0,0 +1,139 @@
+"""Per-user reports (個人報表) of wrong questions and section scores, exported as one ZIP archive."""
+import csv
+import io
+import multiprocessing
+import os
+import re
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import rollups
+import wrong_log
+
+# 每個工作單位處理的使用者數
+USERS_PER_TASK = 50
+
+# 使用者數超過此值才啟動多個行程 (行程啟動本身約需數百毫秒)
+PARALLEL_MIN_USERS = 200
+
+SCORE_COLUMNS = ["章節", "作答題數", "答對題數", "正確率"]
+WRONG_COLUMNS = ["時間", "章節", "題號", "題目", "你的答案", "你的內容", "正確答案", "正確內容", "解析"]
+_WRONG_SOURCE = ["時間", "章節", "題號", "題目", "使用者答案", "使用者內容", "正確答案", "正確內容", "解析"]
+
+
+def _file_name(username):
+    """Returns a username made safe as a file name inside the archive."""
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", username).strip("._") or "user"
+
+
+def _tables(sections, entries):
+    scores = [
+        (section, attempts, correct, round(correct / attempts, 3) if attempts else 0.0)
+        for section, attempts, correct in sections
+    ]
+    attempts = sum(a for _, a, _ in sections)
+    if attempts:
+        scores.append(("全部", attempts, sum(c for _, _, c in sections), round(sum(c for _, _, c in sections) / attempts, 3)))
+    wrong = [tuple(entry.get(column, "") for column in _WRONG_SOURCE) for entry in entries]
+    return scores, wrong
+
+
+def build_report(name, sections, entries, fmt):
+    """Returns [(archive name, bytes)] of one user's report: an xlsx with two sheets, or two CSV files."""
+    scores, wrong = _tables(sections, entries)
+    if fmt == "xlsx":
+        from openpyxl import Workbook # Imported on first export, not when the app starts
+        wb = Workbook(write_only=True)
+        for title, columns, rows in (("章節成績", SCORE_COLUMNS, scores), ("錯題", WRONG_COLUMNS, wrong)):
+            ws = wb.create_sheet(title)
+            ws.append(columns)
+            for row in rows:
+                ws.append(row)
+        buffer = io.BytesIO()
+        wb.save(buffer)
+        return [(f"{name}.xlsx", buffer.getvalue())]
+
+    files = []
+    for title, columns, rows in (("章節成績", SCORE_COLUMNS, scores), ("錯題", WRONG_COLUMNS, wrong)):
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow(columns)
+        writer.writerows(rows)
+        files.append((f"{name}/{title}.csv", text.getvalue().encode("utf-8-sig"))) # utf-8-sig for Excel
+    return files
+
+
+def _build_chunk(wrong_log_path, rollup_path, users, fmt):
+    """Builds the reports of a chunk of (user_key, file name) pairs; runs in a worker process."""
+    keys = [key for key, _ in users]
+    entries = wrong_log.open_wrong_log(wrong_log_path).user_entries(keys)
+    sections = rollups.AnswerRollups(rollup_path).user_sections(keys)
+    files = []
+    for key, name in users:
+        files += build_report(name, sections[key], entries[key], fmt)
+    return len(users), files
+
+
+def _bounded_map(executor, chunks, wrong_log_path, rollup_path, fmt):
+    """Yields chunk results in order, keeping at most two tasks per worker in flight."""
+    window = 2 * executor._max_workers
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(_build_chunk, wrong_log_path, rollup_path, chunk, fmt))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def export_reports(wrong_log_path, rollup_path, zip_path, fmt="xlsx", workers=None, progress=None):
+    """Writes every user's report into a ZIP file. Returns the number of users.
+
+    Users are processed in chunks, across worker processes for large cohorts. Each chunk is added
+    to the archive as soon as it is done, so only a few chunks of reports are ever held in memory.
+    progress(done, total) is called after each chunk.
+    """
+    names = rollups.AnswerRollups(rollup_path).users()
+    for username in wrong_log.open_wrong_log(wrong_log_path).users():
+        names.setdefault(wrong_log.user_key(username), username)
+    users = []
+    used = set()
+    for key, username in sorted(names.items(), key=lambda item: item[1]):
+        # Two usernames can map to the same file name; number the later ones
+        name, n = _file_name(username), 1
+        while name.lower() in used:
+            n += 1
+            name = f"{_file_name(username)}_{n}"
+        used.add(name.lower())
+        users.append((key, name))
+    chunks = [users[i:i + USERS_PER_TASK] for i in range(0, len(users), USERS_PER_TASK)]
+
+    executor = None
+    if len(users) >= PARALLEL_MIN_USERS and workers != 1:
+        # spawn: forking the multi-threaded Streamlit server is not safe
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        results = _bounded_map(executor, chunks, wrong_log_path, rollup_path, fmt)
+    else:
+        results = (_build_chunk(wrong_log_path, rollup_path, chunk, fmt) for chunk in chunks)
+
+    os.makedirs(os.path.dirname(os.path.abspath(zip_path)), exist_ok=True)
+    tmp_path = f"{zip_path}.{os.getpid()}.tmp"
+    # xlsx files are already deflated; compressing them again only costs time
+    compression = zipfile.ZIP_STORED if fmt == "xlsx" else zipfile.ZIP_DEFLATED
+    done = 0
+    try:
+        with zipfile.ZipFile(tmp_path, "w", compression=compression) as archive:
+            for count, files in results:
+                for name, data in files:
+                    archive.writestr(name, data)
+                done += count
+                if progress is not None:
+                    progress(done, len(users))
+        os.replace(tmp_path, zip_path)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return len(users)
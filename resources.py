@@ -0,0 +1,169 @@
+"""Process-wide cached resources shared by every session: the bank registry, loaded banks, their indexes and stores.
+
+The loaders live in a module rather than in app.py so that serve.py can call them at server boot
+(prewarm) and the first session finds them in the same st.cache_resource caches.
+"""
+import os
+
+import pandas as pd
+import streamlit as st
+
+import bank
+import banks
+import duplicates
+import perf
+import rollups
+import search_index
+import sessions
+import stats_log
+import wrong_log
+
+# 檔案路徑設定
+BANK_DIR = os.environ.get("QUIZ_BANK_DIR", ".") # 題庫目錄：其中每個具備題庫欄位的工作表都是一個題庫
+EXCEL_PATH = "行銷題庫總表.xlsx" # 預設題庫
+SHEET_NAME = "題庫總表"
+# 以下資料檔依題庫分開存放；預設題庫沿用原檔名，其他題庫附加題庫名稱 (見 banks.BankSource.data_path)
+WRONG_LOG = "錯題紀錄.db"
+STATS_LOG = "答題統計.csv" # 每次作答由背景執行緒批次寫入
+ROLLUP_DB = "答題彙總.db" # 題目與使用者章節的答題彙總，由答題統計寫入器逐批更新
+# 同時保留在記憶體中的題庫數；快取滿時最久未使用的題庫 (及其索引) 先被釋放
+MAX_LOADED_BANKS = 3
+# 作答進度：所有題庫共用一個檔案；閒置超過 QUIZ_SESSION_IDLE_SECONDS 秒的測驗寫出到磁碟並釋放記憶體
+SESSION_DB = "作答進度.db"
+SESSION_IDLE_SECONDS = float(os.environ.get("QUIZ_SESSION_IDLE_SECONDS", "900"))
+MAX_RESIDENT_SESSIONS = int(os.environ.get("QUIZ_MAX_RESIDENT_SESSIONS", "1000")) # 記憶體中同時保留的測驗數上限 (LRU)
+
+
+# 題庫清單：僅讀取各活頁簿的標題列，目錄中的活頁簿新增或變更時重新掃描
+@st.cache_resource(max_entries=1)
+def load_bank_registry(directory_signature):
+    """Discovers the question banks in the bank directory."""
+    return banks.discover_banks(BANK_DIR, EXCEL_PATH, SHEET_NAME)
+
+
+def cache_key(source):
+    """Returns the (workbook, sheet, signature) cache key of a bank."""
+    return (source.excel_path, source.sheet_name, bank.source_signature(source.excel_path))
+
+
+# 題庫載入失敗的訊息 (以快取鍵為鍵)；由 app.py 每次重跑顯示一次，而不在快取函式中呼叫 st.error
+# (快取函式中的 st.error 會在每個呼叫它的衍生快取中重播)
+_load_errors = {}
+
+
+# 使用st.cache_resource共用題庫 (來自記憶體映射的快照)，題庫檔案變更時依簽章自動重新載入
+# 以下各快取皆以 (活頁簿, 工作表, 簽章) 為鍵，最多保留 MAX_LOADED_BANKS 份並依最近使用 (LRU) 淘汰
+# 注意：回傳的 DataFrame 由所有 session 共用，請勿直接修改
+@st.cache_resource(max_entries=MAX_LOADED_BANKS)
+def load_data(excel_path, sheet_name, source_signature):
+    """Loads the question data from the compiled snapshot of the Excel file; an empty frame if it fails (see load_error)."""
+    perf.mark_miss()
+    key = (excel_path, sheet_name, source_signature)
+    try:
+        frame = bank.load_question_frame(excel_path, sheet_name)
+    except FileNotFoundError:
+        _load_errors[key] = f"錯誤：找不到題庫檔案 `{excel_path}`。請確認檔案是否存在。"
+        return pd.DataFrame() # Return empty dataframe on error
+    except Exception as e:
+        _load_errors[key] = f"載入題庫時發生錯誤：{e}"
+        return pd.DataFrame()
+    _load_errors.pop(key, None)
+    return frame
+
+
+def load_error(excel_path, sheet_name, source_signature):
+    """Returns the error message of a bank that failed to load, or None."""
+    return _load_errors.get((excel_path, sheet_name, source_signature))
+
+
+# 章節/小節 -> 列位置索引 (章節分組由題庫的「章節」值推導)，於題庫載入時建立一次
+@st.cache_resource(max_entries=MAX_LOADED_BANKS)
+def load_index(excel_path, sheet_name, source_signature):
+    """Builds the section/chapter row index of the cached question data."""
+    perf.mark_miss()
+    return bank.BankIndex(load_data(excel_path, sheet_name, source_signature))
+
+
+# 管理者編輯覆蓋層：編輯先套用到記憶體中的題庫，稍後再一次寫回題庫檔案
+@st.cache_resource
+def get_edit_overlay(excel_path, sheet_name):
+    """Opens the shared overlay of pending question edits of one bank."""
+    return bank.EditOverlay(excel_path, sheet_name)
+
+
+# 相似題目群組 (MinHash/LSH)，於題庫載入時建立一次；題庫檔案寫回並重新載入後才反映編輯
+@st.cache_resource(max_entries=MAX_LOADED_BANKS)
+def load_duplicates(excel_path, sheet_name, source_signature):
+    """Finds the near-duplicate question clusters of the cached question data."""
+    perf.mark_miss()
+    return duplicates.DuplicateIndex(load_data(excel_path, sheet_name, source_signature))
+
+
+# 題庫編輯搜尋用的字元 n-gram 索引，與題庫共用相同的快取鍵 (僅管理者搜尋時建立)
+@st.cache_resource(max_entries=MAX_LOADED_BANKS)
+def load_search_index(excel_path, sheet_name, source_signature):
+    """Builds the keyword search index of the cached question data."""
+    perf.mark_miss()
+    return search_index.SearchIndex(load_data(excel_path, sheet_name, source_signature))
+
+
+# 錯題紀錄儲存 (SQLite WAL)，每個題庫一個實例，由所有 session 共用
+@st.cache_resource
+def get_wrong_log(path):
+    """Opens the shared wrong-answer log store of one bank."""
+    return wrong_log.open_wrong_log(path)
+
+
+# 使用者錯題索引 (使用者 -> 小節 -> 題庫列位置)，錯題再練時不需讀取錯題紀錄；題庫重新載入時一併重建
+@st.cache_resource(max_entries=MAX_LOADED_BANKS)
+def load_wrong_index(excel_path, sheet_name, source_signature, wrong_log_path):
+    """Builds the per-user wrong-question index for the cached question data."""
+    perf.mark_miss()
+    return wrong_log.WrongQuestionIndex(get_wrong_log(wrong_log_path), load_index(excel_path, sheet_name, source_signature).positions)
+
+
+# 答題彙總 (學習分析用)，首次建立時由既有的答題統計重建
+@st.cache_resource
+def get_rollups(path, stats_path):
+    """Opens the shared answer rollups of one bank, building them from its stats log if they are new."""
+    is_new = not os.path.exists(path)
+    store = rollups.AnswerRollups(path)
+    if is_new:
+        store.rebuild(stats_path)
+    return store
+
+
+# 答題統計寫入器：作答事件先放入佇列，由背景執行緒批次寫入，不阻塞畫面重跑
+@st.cache_resource(on_release=lambda writer: writer.close())
+def get_stats_writer(path, rollup_path):
+    """Starts the shared background writer for the answer statistics of one bank."""
+    # Each written batch is also added to the rollups on the writer thread
+    return stats_log.AnswerEventWriter(path, listeners=[get_rollups(rollup_path, path).apply])
+
+
+# 作答進度儲存：進行中的測驗保留在記憶體 (有上限)，閒置或被淘汰時寫出，下次開啟時自動還原
+@st.cache_resource(on_release=lambda store: store.spill_all())
+def get_quiz_sessions(path):
+    """Opens the shared quiz progress store."""
+    return sessions.QuizSessionStore(path, idle_seconds=SESSION_IDLE_SECONDS, max_resident=MAX_RESIDENT_SESSIONS)
+
+
+def prewarm(bank_count=1):
+    """Fills the caches a first session needs, for the first bank_count banks (the default bank first).
+
+    Builds the registry, each bank with its row, near-duplicate and wrong-question indexes, and
+    opens its stores and stats writer. The admin search index is left to the first search.
+    Returns the ids of the banks loaded.
+    """
+    sources = load_bank_registry(banks.directory_signature(BANK_DIR))
+    loaded = []
+    for source in sources[:min(bank_count, MAX_LOADED_BANKS)]:
+        key = cache_key(source)
+        if load_data(*key).empty:
+            continue
+        load_index(*key)
+        load_duplicates(*key)
+        load_wrong_index(*key, source.data_path(WRONG_LOG))
+        get_stats_writer(source.data_path(STATS_LOG), source.data_path(ROLLUP_DB))
+        loaded.append(source.id)
+    return loaded
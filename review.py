@@ -0,0 +1,66 @@
+"""Spaced-repetition scheduling (間隔複習) of wrong questions for 錯題再練模式.
+
+Each (使用者, question) in the wrong log carries an SM-2 style state: ease, interval, due time and
+correct streak. A wrong answer (in a quiz or a drill) resets the streak and brings the question back
+soon; a correct drill answer on a due question pushes it out by interval * ease. After
+RETIRE_STREAK correct reviews in a row the question retires and leaves the drill set.
+"""
+import numpy as np
+
+INITIAL_EASE = 2.5
+MIN_EASE = 1.3
+MAX_EASE = 3.0
+EASE_STEP = 0.1 # 答對加、答錯減 (答錯減兩倍)
+
+FIRST_INTERVAL_DAYS = 1.0
+LAPSE_DELAY_SECONDS = 10 * 60 # 答錯後多久再出現
+
+# 連續答對 (且皆於到期後作答) 幾次後自動移出錯題再練
+RETIRE_STREAK = 3
+
+DAY_SECONDS = 86400.0
+
+
+class ReviewState:
+    """Scheduling state of one wrong question of one user."""
+
+    __slots__ = ("ease", "interval_days", "due_at", "streak")
+
+    def __init__(self, ease=INITIAL_EASE, interval_days=0.0, due_at=0.0, streak=0):
+        self.ease = ease
+        self.interval_days = interval_days
+        self.due_at = due_at # Epoch seconds
+        self.streak = streak
+
+    @property
+    def retired(self):
+        return self.streak >= RETIRE_STREAK
+
+    def answered(self, correct, now):
+        """Returns the state after a drill answer at time now.
+
+        A correct answer before the question is due leaves the schedule as it is, so repeating a
+        question early does not count towards retiring it.
+        """
+        if not correct:
+            return ReviewState(max(MIN_EASE, self.ease - 2 * EASE_STEP), 0.0, now + LAPSE_DELAY_SECONDS, 0)
+        if now < self.due_at:
+            return self
+        interval = FIRST_INTERVAL_DAYS if self.interval_days < FIRST_INTERVAL_DAYS else self.interval_days * self.ease
+        return ReviewState(min(MAX_EASE, self.ease + EASE_STEP), interval, now + interval * DAY_SECONDS, self.streak + 1)
+
+
+def drill_order(due_at, interval_days, ease, now, rng):
+    """Returns the item indices in drill order: due items first, then the others soonest first.
+
+    Due items are ordered by a weighted random draw without replacement (each gets the key
+    u ** (1 / weight)); the weight grows with how overdue an item is relative to its interval and
+    with how hard it is (low ease). Everything is computed over whole arrays in one pass.
+    """
+    due_at = np.asarray(due_at, dtype=np.float64)
+    overdue = now - due_at
+    scale = np.maximum(np.asarray(interval_days, dtype=np.float64) * DAY_SECONDS, LAPSE_DELAY_SECONDS)
+    weight = (1.0 + np.maximum(overdue, 0.0) / scale) * (INITIAL_EASE / np.asarray(ease, dtype=np.float64))
+    # Due keys fall in (0, 1]; items not yet due get negative keys, closest to zero when due soonest
+    keys = np.where(overdue >= 0, rng.random(len(due_at)) ** (1.0 / weight), -1.0 - (due_at - now) / DAY_SECONDS)
+    return np.argsort(-keys, kind="stable")
@@ -0,0 +1,172 @@
+"""Answer rollups (答題彙總) per question and per (使用者, 章節), kept in SQLite for the admin dashboard."""
+import os
+import sqlite3
+from contextlib import closing
+
+import pandas as pd
+
+from wrong_log import user_key
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS question_rollup (
+    section TEXT NOT NULL,
+    number TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    correct INTEGER NOT NULL,
+    last_seen TEXT,
+    PRIMARY KEY (section, number)
+);
+CREATE INDEX IF NOT EXISTS question_rollup_accuracy ON question_rollup (1.0 * correct / attempts, attempts DESC);
+CREATE TABLE IF NOT EXISTS user_section_rollup (
+    user_key TEXT NOT NULL,
+    user TEXT NOT NULL,
+    section TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    correct INTEGER NOT NULL,
+    last_seen TEXT,
+    PRIMARY KEY (user_key, section)
+);
+"""
+
+_UPSERT = """
+INSERT INTO {table} ({keys}, attempts, correct, last_seen) VALUES ({placeholders}, ?, ?, ?)
+ON CONFLICT ({conflict}) DO UPDATE SET
+    attempts = attempts + excluded.attempts,
+    correct = correct + excluded.correct,
+    last_seen = max(coalesce(last_seen, ''), excluded.last_seen)
+"""
+
+
+def _is_correct(value):
+    return value is True or str(value).strip().lower() in ("true", "1")
+
+
+def _aggregate(events):
+    """Sums a batch of answer events into {key: [attempts, correct, last_seen]} per rollup."""
+    questions, users = {}, {}
+    for e in events:
+        section, seen = str(e.get("章節", "")), str(e.get("時間", ""))
+        correct = _is_correct(e.get("是否正確"))
+        name = str(e.get("使用者", ""))
+        for totals, key in ((questions, (section, str(e.get("題號", "")))), (users, (user_key(name), name, section))):
+            item = totals.setdefault(key, [0, 0, ""])
+            item[0] += 1
+            item[1] += correct
+            item[2] = max(item[2], seen)
+    return questions, users
+
+
+class AnswerRollups:
+    """Attempts, correct answers and last-seen time per (章節, 題號) and per (使用者, 章節).
+
+    The tables are updated with one upsert per key and batch, so the dashboard reads a few small
+    tables instead of scanning the raw answer log; rebuild() recomputes them from that log.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _upsert(self, conn, questions, users):
+        conn.executemany(
+            _UPSERT.format(table="question_rollup", keys="section, number", placeholders="?, ?", conflict="section, number"),
+            [key + tuple(totals) for key, totals in questions.items()]
+        )
+        conn.executemany(
+            _UPSERT.format(table="user_section_rollup", keys="user_key, user, section", placeholders="?, ?, ?", conflict="user_key, section"),
+            [key + tuple(totals) for key, totals in users.items()]
+        )
+
+    def apply(self, events):
+        """Adds a batch of answer events (dicts keyed by stats_log.STATS_COLUMNS) in one transaction."""
+        questions, users = _aggregate(events)
+        if not questions:
+            return
+        with closing(self._connect()) as conn, conn:
+            self._upsert(conn, questions, users)
+
+    def rebuild(self, stats_path, chunksize=100000):
+        """Recomputes both tables from the raw answer log (答題統計.csv). Returns the number of events read.
+
+        Run it on the stats writer thread (AnswerEventWriter.call) so no batch lands between the
+        read of the log and the replacement of the tables.
+        """
+        questions, users = {}, {}
+        read = 0
+        try:
+            chunks = pd.read_csv(stats_path, dtype=str, keep_default_na=False, encoding="utf-8-sig", chunksize=chunksize)
+            for chunk in chunks:
+                read += len(chunk)
+                chunk_questions, chunk_users = _aggregate(chunk.to_dict("records"))
+                for totals, chunk_totals in ((questions, chunk_questions), (users, chunk_users)):
+                    for key, (attempts, correct, seen) in chunk_totals.items():
+                        item = totals.setdefault(key, [0, 0, ""])
+                        item[0] += attempts
+                        item[1] += correct
+                        item[2] = max(item[2], seen)
+        except (FileNotFoundError, pd.errors.EmptyDataError):
+            pass # No answers logged yet: the rollups become empty
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM question_rollup")
+            conn.execute("DELETE FROM user_section_rollup")
+            self._upsert(conn, questions, users)
+        return read
+
+    def totals(self):
+        """Returns (attempts, correct, distinct users) over every answer."""
+        with closing(self._connect()) as conn:
+            attempts, correct = conn.execute("SELECT coalesce(sum(attempts), 0), coalesce(sum(correct), 0) FROM question_rollup").fetchone()
+            users = conn.execute("SELECT count(DISTINCT user_key) FROM user_section_rollup").fetchone()[0]
+        return attempts, correct, users
+
+    def users(self):
+        """Returns {user_key: username} of every user with recorded answers."""
+        with closing(self._connect()) as conn:
+            return dict(conn.execute("SELECT user_key, min(user) FROM user_section_rollup GROUP BY user_key"))
+
+    def user_sections(self, user_keys):
+        """Returns {user_key: [(章節, attempts, correct)]} for the given normalized users, in section order."""
+        sections = {key: [] for key in user_keys}
+        if not sections:
+            return sections
+        placeholders = ", ".join("?" * len(sections))
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT user_key, section, attempts, correct FROM user_section_rollup WHERE user_key IN ({placeholders}) ORDER BY section",
+                list(sections)
+            )
+            for key, section, attempts, correct in rows:
+                sections[key].append((section, attempts, correct))
+        return sections
+
+    def hardest_questions(self, limit=20, min_attempts=5):
+        """Returns the questions with the lowest accuracy (at least min_attempts answers) as a DataFrame."""
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(
+                """SELECT section AS 章節, number AS 題號, attempts AS 作答人次, attempts - correct AS 答錯人次,
+                          round(1.0 * (attempts - correct) / attempts, 3) AS 錯誤率, last_seen AS 最後作答
+                   FROM question_rollup WHERE attempts >= ?
+                   ORDER BY 1.0 * correct / attempts, attempts DESC LIMIT ?""",
+                conn, params=(min_attempts, limit)
+            )
+
+    def section_accuracy(self, max_users=30):
+        """Returns accuracy per (使用者, 章節) for the max_users most active users, plus an 全部 row per section."""
+        with closing(self._connect()) as conn:
+            return pd.read_sql_query(
+                """WITH active AS (
+                       SELECT user_key FROM user_section_rollup GROUP BY user_key ORDER BY sum(attempts) DESC LIMIT ?
+                   )
+                   SELECT u.user AS 使用者, u.section AS 章節, u.attempts AS 作答題數,
+                          round(1.0 * u.correct / u.attempts, 3) AS 正確率
+                   FROM user_section_rollup u JOIN active USING (user_key)
+                   UNION ALL
+                   SELECT '全部', section, sum(attempts), round(1.0 * sum(correct) / sum(attempts), 3)
+                   FROM user_section_rollup GROUP BY section""",
+                conn, params=(max_users,)
+            )
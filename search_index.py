@@ -0,0 +1,88 @@
+"""Character n-gram inverted index for the admin keyword search (題庫編輯)."""
+from collections import defaultdict
+
+# 搜尋欄位與排序權重 (題目命中優先)
+SEARCH_FIELDS = {"題目": 3, "A": 1, "B": 1, "C": 1, "D": 1, "解析": 1}
+
+GRAM_SIZE = 2
+
+
+def _field_text(value):
+    return "" if value is None or value != value else str(value).lower()
+
+
+def _grams(text):
+    return {text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1)}
+
+
+class SearchIndex:
+    """Inverted index of character bigrams over 題目, options A-D and 解析, with stable row ids.
+
+    Chinese text has no word boundaries, so every two-character window is indexed; a query is
+    answered by intersecting the postings of its bigrams and confirming the substring in the few
+    candidates that remain.
+    """
+
+    def __init__(self, frame):
+        self.postings = defaultdict(set) # bigram -> row ids
+        self.fields = [] # row id -> indexed (lower-cased) field texts
+        self.labels = [] # row id -> "章節-題號 題目" shown in the selectbox
+        for row, record in enumerate(frame.to_dict("records")):
+            fields = tuple(_field_text(record.get(name)) for name in SEARCH_FIELDS)
+            self.fields.append(fields)
+            self.labels.append(self._label(record))
+            for gram in set().union(*map(_grams, fields)):
+                self.postings[gram].add(row)
+
+    @staticmethod
+    def _label(record):
+        return f"{record.get('章節')}-{record.get('題號')} {record.get('題目')}"
+
+    def update(self, row, record):
+        """Re-indexes one row if its text changed. Returns True if it did."""
+        fields = tuple(_field_text(record.get(name)) for name in SEARCH_FIELDS)
+        if fields == self.fields[row]:
+            return False
+        old_grams = set().union(*map(_grams, self.fields[row]))
+        new_grams = set().union(*map(_grams, fields))
+        for gram in old_grams - new_grams:
+            self.postings[gram].discard(row)
+        for gram in new_grams - old_grams:
+            self.postings[gram].add(row)
+        self.fields[row] = fields
+        self.labels[row] = self._label(record)
+        return True
+
+    def refresh(self, frame, rows):
+        """Re-indexes the given rows from the bank frame (e.g. the rows with pending edits)."""
+        for row in rows:
+            self.update(row, frame.iloc[row].to_dict())
+
+    def _matches(self, term):
+        grams = _grams(term)
+        if not grams:
+            # A single character has no bigram; scan the stored texts instead (rare, short queries)
+            return {row for row, fields in enumerate(self.fields) if any(term in f for f in fields)}
+        postings = sorted((self.postings.get(g, set()) for g in grams), key=len)
+        candidates = set(postings[0]).intersection(*postings[1:])
+        # Bigram hits can be out of order, so confirm the term itself appears
+        return {row for row in candidates if any(term in f for f in self.fields[row])}
+
+    def search(self, keyword):
+        """Returns the row ids matching every whitespace-separated term, best matches first."""
+        terms = keyword.lower().split()
+        if not terms:
+            return list(range(len(self.fields)))
+        rows = self._matches(terms[0])
+        for term in terms[1:]:
+            if not rows:
+                break
+            rows &= self._matches(term)
+
+        weights = tuple(SEARCH_FIELDS.values())
+
+        def score(row):
+            fields = self.fields[row]
+            return -sum(w for w, f in zip(weights, fields) if any(t in f for t in terms)), row
+
+        return sorted(rows, key=score)
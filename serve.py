@@ -0,0 +1,37 @@
+"""Starts the quiz app with its caches prewarmed, so the first user after a restart does not wait for them.
+
+Usage (from the repository root, instead of `streamlit run app.py`):
+
+    python serve.py
+    python serve.py --server.port 8502         # any other `streamlit run` option
+    QUIZ_PREWARM_BANKS=3 python serve.py       # also load the next banks of the bank directory
+
+Before the server starts listening, the bank registry, the default bank and its indexes are built
+in this process (resources.prewarm). The Streamlit server then runs in the same process, so the
+first session finds them in st.cache_resource instead of building them.
+"""
+import logging
+import os
+import sys
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    start = time.perf_counter()
+    import resources # Pays the pandas/pyarrow/Streamlit import cost before the first request
+    imported = time.perf_counter()
+    # Outside a session every cached loader warns about the missing script context; that is expected here
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").setLevel(logging.ERROR)
+    loaded = resources.prewarm(int(os.environ.get("QUIZ_PREWARM_BANKS", "1")))
+    print(f"預先載入題庫 {', '.join(loaded) or '(無)'}：匯入 {imported - start:.2f} 秒，"
+          f"載入與建立索引 {time.perf_counter() - imported:.2f} 秒", file=sys.stderr)
+
+    from streamlit.web import cli
+    return cli.main.main(args=["run", APP_PATH, *argv], prog_name="streamlit")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,248 @@
+"""Quiz progress (作答進度) kept off the session state, spilled to SQLite when idle so it survives restarts.
+
+Every quiz gets its own key (new_quiz_key), held by the Streamlit session that started it; no
+other session ever reads or replaces it. The QuizState and the settings that started it stay in
+a bounded in-memory LRU. A quiz that has not been touched for idle_seconds, or that falls off the
+end of the LRU, is written to disk under both its key and its resume key (題庫 + 使用者) and
+dropped from memory. Its own session restores it transparently on the next access; a new session
+of the same user (another tab, or after a restart) can take over a spilled quiz that no live
+session holds. Restores are timed as the "session_restore" span.
+"""
+import atexit
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import closing
+
+import perf
+import quiz
+import wrong_log
+
+# 寫出後超過此天數未再開啟的作答進度，於清理時刪除
+RETENTION_DAYS = 14
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS quiz_sessions (
+    quiz_key TEXT PRIMARY KEY,
+    resume_key TEXT NOT NULL,
+    saved_at REAL NOT NULL,
+    state BLOB NOT NULL,
+    settings TEXT
+);
+CREATE INDEX IF NOT EXISTS quiz_sessions_resume ON quiz_sessions (resume_key, saved_at);
+CREATE INDEX IF NOT EXISTS quiz_sessions_saved ON quiz_sessions (saved_at);
+"""
+
+
+def new_quiz_key():
+    """Returns a fresh key for a quiz started by one session."""
+    return uuid.uuid4().hex
+
+
+def resume_key(bank_id, username):
+    """Returns the key under which a user's spilled quizzes in one bank are found (usernames match case-insensitively)."""
+    return f"{bank_id}\x1f{wrong_log.user_key(username)}"
+
+
+class QuizSession:
+    """One quiz: its QuizState, the settings that started it, its resume key and when it was last used."""
+
+    __slots__ = ("state", "settings", "resume_key", "touched", "done")
+
+    def __init__(self, state, settings, resume_key, touched):
+        self.state = state
+        self.settings = settings
+        self.resume_key = resume_key
+        self.touched = touched # time.monotonic() of the last access
+        self.done = False # Completed: dropped instead of spilled, never resumed
+
+
+class QuizSessionStore:
+    """Bounded LRU of live quizzes in front of a SQLite table of spilled ones.
+
+    At most max_resident quizzes are held in memory; sweep() spills those idle for longer than
+    idle_seconds. Every resident quiz is spilled when the process exits. One instance is shared
+    by every Streamlit session thread; all access goes through one lock, so a quiz is never read
+    from disk while its newer copy is being written.
+    """
+
+    def __init__(self, path, idle_seconds=900, max_resident=1000, sweep_interval=30.0):
+        self.path = os.path.abspath(path)
+        self.idle_seconds = idle_seconds
+        self.max_resident = max_resident
+        self.sweep_interval = sweep_interval
+        self._resident = OrderedDict() # quiz key -> QuizSession, least recently used first
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+        atexit.register(self.spill_all)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def put(self, key, resume_key, state, settings):
+        """Stores (or refreshes) a quiz as the most recently used one."""
+        with self._lock:
+            self._resident[key] = QuizSession(state, settings, resume_key, time.monotonic())
+            self._resident.move_to_end(key)
+            self._evict()
+
+    def get(self, key):
+        """Returns the QuizSession of a key, restoring it from disk if it was spilled, or None."""
+        with self._lock:
+            session = self._resident.get(key)
+            if session is not None:
+                self._resident.move_to_end(key)
+                session.touched = time.monotonic()
+                return session
+            start = time.perf_counter()
+            with closing(self._connect()) as conn:
+                row = conn.execute("SELECT resume_key, state, settings FROM quiz_sessions WHERE quiz_key = ?", (key,)).fetchone()
+            session = self._load(key, row) if row is not None else None
+            if session is not None:
+                # The disk copy stays until the quiz is spilled again, finished or expired
+                self._make_resident(key, session)
+        if session is not None:
+            self._record_restore(start)
+        return session
+
+    def claim(self, key, resume_key):
+        """Moves the latest unfinished spilled quiz of a resume key to a new quiz key and returns it, or None.
+
+        Quizzes held in memory belong to a live session and are never taken over; the spilled
+        copy of one that was restored meanwhile is skipped for the same reason.
+        """
+        with self._lock:
+            start = time.perf_counter()
+            with closing(self._connect()) as conn:
+                rows = conn.execute(
+                    "SELECT quiz_key, resume_key, state, settings FROM quiz_sessions WHERE resume_key = ? ORDER BY saved_at DESC",
+                    (resume_key,)
+                ).fetchall()
+            for old_key, *row in rows:
+                if old_key in self._resident:
+                    continue
+                session = self._load(old_key, row)
+                if session is None or session.state.answered_count >= len(session.state.rows):
+                    continue
+                # The old key is left with nothing; its session (if still open) is told to start again
+                with closing(self._connect()) as conn, conn:
+                    conn.execute("DELETE FROM quiz_sessions WHERE quiz_key = ?", (old_key,))
+                self._make_resident(key, session)
+                break
+            else:
+                return None
+        self._record_restore(start)
+        return session
+
+    def finish(self, key):
+        """Marks a completed quiz: its disk copy is deleted and it is dropped, not spilled, once idle or evicted."""
+        with self._lock:
+            session = self._resident.get(key)
+            if session is not None:
+                session.done = True
+            with closing(self._connect()) as conn, conn:
+                conn.execute("DELETE FROM quiz_sessions WHERE quiz_key = ?", (key,))
+
+    def discard(self, key):
+        """Forgets a quiz, in memory and on disk (e.g. when its session starts another one)."""
+        with self._lock:
+            self._resident.pop(key, None)
+            with closing(self._connect()) as conn, conn:
+                conn.execute("DELETE FROM quiz_sessions WHERE quiz_key = ?", (key,))
+
+    def spill(self, key):
+        """Writes one quiz to disk now and drops it from memory (e.g. when its session leaves it for another bank)."""
+        with self._lock:
+            if key in self._resident:
+                self._spill([key])
+
+    def maybe_sweep(self):
+        """Runs sweep() at most once per sweep_interval seconds."""
+        now = time.monotonic()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        try:
+            self.sweep(now)
+        except sqlite3.Error:
+            logger.exception("寫出閒置作答進度失敗")
+
+    def sweep(self, now=None):
+        """Spills the quizzes idle for longer than idle_seconds and deletes expired ones from disk. Returns the count spilled."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            # The LRU order is also the order of last access, so the idle ones are at the front
+            idle = []
+            for key, session in self._resident.items():
+                if now - session.touched < self.idle_seconds:
+                    break
+                idle.append(key)
+            self._spill(idle)
+            with closing(self._connect()) as conn, conn:
+                conn.execute("DELETE FROM quiz_sessions WHERE saved_at < ?", (time.time() - RETENTION_DAYS * 86400,))
+        return len(idle)
+
+    def spill_all(self):
+        """Writes every resident quiz to disk and drops it from memory (at process exit)."""
+        with self._lock:
+            self._spill(list(self._resident))
+
+    def resident_count(self):
+        return len(self._resident)
+
+    def spilled_count(self):
+        """Returns the number of quizzes on disk (including the stale copies of resident ones)."""
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM quiz_sessions").fetchone()[0]
+
+    def _load(self, key, row):
+        """Returns the QuizSession of a (resume_key, state, settings) disk row, or None if it cannot be read."""
+        resume, blob, settings = row
+        try:
+            return QuizSession(quiz.QuizState.loads(blob), json.loads(settings) if settings else None, resume, time.monotonic())
+        except (ValueError, KeyError, TypeError):
+            logger.exception("無法還原作答進度 %r", key)
+            return None
+
+    def _make_resident(self, key, session):
+        """Adds a restored quiz as the most recently used one. Called with the lock held."""
+        self._resident[key] = session
+        self._evict()
+
+    def _record_restore(self, start):
+        perf.observe("session_restore", time.perf_counter() - start)
+        perf.count("session", "restore")
+
+    def _evict(self):
+        """Spills the least recently used quizzes beyond max_resident. Called with the lock held."""
+        overflow = len(self._resident) - self.max_resident
+        if overflow > 0:
+            self._spill([key for key, _ in zip(self._resident, range(overflow))])
+
+    def _spill(self, keys):
+        """Writes the unfinished quizzes of keys in one transaction, then drops all of them from memory. Called with the lock held."""
+        if not keys:
+            return
+        saved_at = time.time()
+        rows = [
+            (key, session.resume_key, saved_at, session.state.dumps(), json.dumps(session.settings, ensure_ascii=False))
+            for key, session in ((key, self._resident[key]) for key in keys) if not session.done
+        ]
+        if rows:
+            with closing(self._connect()) as conn, conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO quiz_sessions (quiz_key, resume_key, saved_at, state, settings) VALUES (?, ?, ?, ?, ?)", rows
+                )
+        for key in keys:
+            del self._resident[key]
+        perf.count("session", "spill", len(rows))
@@ -0,0 +1,135 @@
+"""Answer statistics (答題統計) recorded through a buffered background writer."""
+import atexit
+import csv
+import logging
+import os
+import queue
+import threading
+import time
+
+# 答題統計欄位
+STATS_COLUMNS = ["使用者", "時間", "章節", "題號", "使用者答案", "是否正確", "作答秒數"]
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class _Task:
+    """A function to run on the writer thread, with its outcome."""
+
+    __slots__ = ("func", "done", "result", "error")
+
+    def __init__(self, func):
+        self.func = func
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _needs_header(path):
+    """Returns True if the file is missing or holds nothing but whitespace (e.g. a blank placeholder)."""
+    try:
+        with open(path, "rb") as f:
+            return not f.read(64).strip()
+    except FileNotFoundError:
+        return True
+
+
+class AnswerEventWriter:
+    """Queues answer events in memory and appends them to the stats CSV from a background thread.
+
+    Events are written in batches once batch_size events are waiting or flush_interval seconds have
+    passed, so recording an answer never touches the disk on the Streamlit script thread. Whatever
+    is still buffered is flushed when the process exits. Each listener is called with every batch
+    once it is on disk (e.g. to update rollups); a failing listener is logged, not retried.
+    """
+
+    def __init__(self, path, batch_size=200, flush_interval=2.0, listeners=()):
+        self.path = os.path.abspath(path) # The writer thread must not depend on the current directory
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.listeners = list(listeners)
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="answer-stats-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, event):
+        """Queues one answer event (a dict keyed by STATS_COLUMNS) without blocking."""
+        self._queue.put_nowait(event)
+
+    def flush(self, timeout=10):
+        """Blocks until every event queued before this call has been written."""
+        if not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def call(self, func, timeout=60):
+        """Runs func on the writer thread after every event queued before this call is written; returns its result."""
+        if not self._thread.is_alive():
+            return func()
+        task = _Task(func)
+        self._queue.put(task)
+        if not task.done.wait(timeout):
+            raise TimeoutError("等待答題統計寫入逾時")
+        if task.error is not None:
+            raise task.error
+        return task.result
+
+    def close(self, timeout=10):
+        """Flushes the buffer and stops the writer thread."""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, dict):
+                batch.append(item)
+            if item is None or item is _STOP or isinstance(item, (threading.Event, _Task)) or len(batch) >= self.batch_size:
+                if batch and self._write(batch):
+                    self._notify(batch)
+                    batch = []
+                deadline = time.monotonic() + self.flush_interval
+            if isinstance(item, threading.Event):
+                item.set()
+            elif isinstance(item, _Task):
+                try:
+                    item.result = item.func()
+                except Exception as e:
+                    item.error = e
+                item.done.set()
+            elif item is _STOP:
+                return
+
+    def _notify(self, batch):
+        for listener in self.listeners:
+            try:
+                listener(batch)
+            except Exception:
+                logger.exception("答題統計後續處理失敗")
+
+    def _write(self, batch):
+        """Appends one batch to the CSV; on failure the batch is kept and retried at the next flush."""
+        try:
+            if _needs_header(self.path):
+                # utf-8-sig so Excel opens the Chinese headers correctly
+                with open(self.path, "w", newline="", encoding="utf-8-sig") as f:
+                    csv.writer(f).writerow(STATS_COLUMNS)
+            with open(self.path, "a", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=STATS_COLUMNS, extrasaction="ignore")
+                writer.writerows(batch)
+            return True
+        except OSError:
+            logger.exception("寫入答題統計失敗，稍後重試")
+            return False
@@ -0,0 +1,331 @@
+"""Wrong-answer log storage (錯題紀錄) backed by an embedded SQLite database."""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import review
+
+# 錯題紀錄欄位 (與舊版 CSV 相同的順序)
+WRONG_LOG_COLUMNS = ["使用者", "時間", "章節", "題號", "題目", "使用者答案", "使用者內容", "正確答案", "正確內容", "解析"]
+
+# CSV 欄位 -> 資料表欄位
+_SQL_COLUMNS = {
+    "使用者": "user",
+    "時間": "answered_at",
+    "章節": "section",
+    "題號": "number",
+    "題目": "question",
+    "使用者答案": "user_label",
+    "使用者內容": "user_text",
+    "正確答案": "correct_label",
+    "正確內容": "correct_text",
+    "解析": "explanation",
+}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS wrong_answers (
+    user TEXT NOT NULL,
+    user_key TEXT NOT NULL,
+    answered_at TEXT,
+    section TEXT NOT NULL,
+    number TEXT NOT NULL,
+    question TEXT,
+    user_label TEXT,
+    user_text TEXT,
+    correct_label TEXT,
+    correct_text TEXT,
+    explanation TEXT
+);
+"""
+
+# One entry, and so one review schedule, per normalized user and question
+_KEY_INDEX = "CREATE UNIQUE INDEX IF NOT EXISTS wrong_answers_user_key ON wrong_answers (user_key, section, number)"
+
+# 舊版索引以原始使用者名稱判斷重複；開啟舊資料庫時先合併僅大小寫不同的重複錯題 (保留最早一筆) 再移除
+_LEGACY_INDEXES = ("wrong_answers_key", "wrong_answers_user")
+_DEDUPE = "DELETE FROM wrong_answers WHERE rowid NOT IN (SELECT min(rowid) FROM wrong_answers GROUP BY user_key, section, number)"
+
+# 間隔複習欄位 (見 review.py)；舊資料庫開啟時補上，既有錯題視為已到期
+_REVIEW_COLUMNS = {
+    "ease": f"REAL NOT NULL DEFAULT {review.INITIAL_EASE}",
+    "interval_days": "REAL NOT NULL DEFAULT 0",
+    "due_at": "REAL NOT NULL DEFAULT 0",
+    "streak": "INTEGER NOT NULL DEFAULT 0",
+    "retired_at": "TEXT",
+}
+
+# Only questions still in the drill set are read back into the in-memory index
+_ACTIVE_INDEX = "CREATE INDEX IF NOT EXISTS wrong_answers_active ON wrong_answers (user_key) WHERE retired_at IS NULL"
+
+_LAPSE = f"""
+UPDATE wrong_answers SET ease = max({review.MIN_EASE}, ease - {2 * review.EASE_STEP}), interval_days = 0, due_at = ?, streak = 0, retired_at = NULL
+WHERE user_key = ? AND section = ? AND number = ?
+"""
+
+
+def user_key(username):
+    """Normalizes a username the way the quiz matches users (case-insensitive)."""
+    return str(username).strip().lower()
+
+
+class SQLiteWrongLog:
+    """Wrong-answer log in a SQLite database in WAL mode, unique per normalized user, 章節 and 題號.
+
+    A connection is opened per call, so one instance can be shared by every Streamlit session thread.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_SCHEMA)
+            existing = {row[1] for row in conn.execute("PRAGMA table_info(wrong_answers)")}
+            indexes = {row[1] for row in conn.execute("PRAGMA index_list(wrong_answers)")}
+            with conn:
+                for column, definition in _REVIEW_COLUMNS.items():
+                    if column not in existing:
+                        conn.execute(f"ALTER TABLE wrong_answers ADD COLUMN {column} {definition}")
+                if indexes & set(_LEGACY_INDEXES):
+                    conn.execute(_DEDUPE)
+                    for name in _LEGACY_INDEXES:
+                        conn.execute(f"DROP INDEX IF EXISTS {name}")
+                conn.execute(_KEY_INDEX)
+                conn.execute(_ACTIVE_INDEX)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add(self, entries, now=None):
+        """Inserts wrong-answer dicts (keyed by WRONG_LOG_COLUMNS). Returns the count inserted.
+
+        A question the user (case-insensitive) already has in the log keeps its first entry, but its review schedule
+        lapses (see review.py): it comes back into the drill set shortly, even if it had retired.
+        """
+        due_at = (time.time() if now is None else now) + review.LAPSE_DELAY_SECONDS
+        rows = [
+            (str(e.get("使用者", "")), user_key(e.get("使用者", ""))) + tuple(
+                str(e.get(col, "")) if col in ("章節", "題號") else e.get(col, "")
+                for col in WRONG_LOG_COLUMNS[1:]
+            ) + (due_at,)
+            for e in entries
+        ]
+        if not rows:
+            return 0
+        columns = ", ".join(["user", "user_key"] + [_SQL_COLUMNS[c] for c in WRONG_LOG_COLUMNS[1:]] + ["due_at"])
+        placeholders = ", ".join("?" * (len(WRONG_LOG_COLUMNS) + 2))
+        insert = f"INSERT OR IGNORE INTO wrong_answers ({columns}) VALUES ({placeholders})"
+        inserted = 0
+        with closing(self._connect()) as conn, conn:
+            for row in rows:
+                if conn.execute(insert, row).rowcount:
+                    inserted += 1
+                else:
+                    conn.execute(_LAPSE, (due_at, row[1], row[3], row[4]))
+        return inserted
+
+    def review(self, username, section, number, state, now):
+        """Stores the review state of one question of a user after a drill answer; retires it if its streak is complete."""
+        retired_at = datetime.fromtimestamp(now).strftime("%Y-%m-%d %H:%M:%S") if state.retired else None
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """UPDATE wrong_answers SET ease = ?, interval_days = ?, due_at = ?, streak = ?, retired_at = ?
+                   WHERE user_key = ? AND section = ? AND number = ?""",
+                (state.ease, state.interval_days, state.due_at, state.streak, retired_at, user_key(username), str(section), str(number))
+            )
+
+    def version(self):
+        """Returns a cheap signature of the database files; it changes whenever any process writes."""
+        signature = []
+        for path in (self.path, self.path + "-wal"):
+            try:
+                stat = os.stat(path)
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return tuple(signature)
+
+    def active_questions(self, user_keys=None):
+        """Returns (user_key, 章節, 題號, ease, interval_days, due_at, streak) of every question not retired.
+
+        Limited to the given normalized users if user_keys is not None.
+        """
+        query = "SELECT user_key, section, number, ease, interval_days, due_at, streak FROM wrong_answers WHERE retired_at IS NULL"
+        params = []
+        if user_keys is not None:
+            params = list(user_keys)
+            query += f" AND user_key IN ({', '.join('?' * len(params))})"
+        with closing(self._connect()) as conn:
+            return conn.execute(query, params).fetchall()
+
+    def users(self):
+        """Returns the distinct usernames in the log."""
+        with closing(self._connect()) as conn:
+            return [r[0] for r in conn.execute("SELECT DISTINCT user FROM wrong_answers ORDER BY user")]
+
+    def user_entries(self, user_keys):
+        """Returns {user_key: [entry dicts keyed by WRONG_LOG_COLUMNS]} for the given normalized users, oldest first."""
+        entries = {key: [] for key in user_keys}
+        if not entries:
+            return entries
+        columns = ", ".join(_SQL_COLUMNS[c] for c in WRONG_LOG_COLUMNS)
+        placeholders = ", ".join("?" * len(entries))
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT user_key, {columns} FROM wrong_answers WHERE user_key IN ({placeholders}) ORDER BY answered_at, section, number",
+                list(entries)
+            )
+            for key, *values in rows:
+                entries[key].append(dict(zip(WRONG_LOG_COLUMNS, values)))
+        return entries
+
+    def clear_user(self, username):
+        """Deletes every entry of one user (case-insensitive). Returns the count deleted."""
+        with closing(self._connect()) as conn, conn:
+            return conn.execute("DELETE FROM wrong_answers WHERE user_key = ?", (user_key(username),)).rowcount
+
+    def clear_all(self):
+        """Deletes every entry of every user."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM wrong_answers")
+
+    def import_csv(self, csv_path, chunksize=10000):
+        """One-shot import of a legacy 錯題紀錄.csv; rows already present are skipped. Returns the count inserted."""
+        inserted = 0
+        try:
+            for chunk in pd.read_csv(csv_path, dtype=str, keep_default_na=False, chunksize=chunksize):
+                inserted += self.add(chunk.reindex(columns=WRONG_LOG_COLUMNS, fill_value="").to_dict("records"))
+        except pd.errors.EmptyDataError:
+            pass # An empty legacy file has nothing to import
+        return inserted
+
+
+class WrongQuestionIndex:
+    """Process-wide map of normalized user -> bank row id -> (章節, 題號, review state) of the questions in the drill set.
+
+    Retired questions are not loaded, so the index holds only each user's active wrong questions.
+    Writes made through the index update it in place; a write by another process (seen as a change
+    of the database files) makes the next lookup rebuild it from the store.
+    """
+
+    def __init__(self, store, positions):
+        self.store = store
+        self.positions = positions # (章節, 題號) -> bank row id
+        self._users = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _load(self, questions):
+        users = {}
+        for key, section, number, ease, interval_days, due_at, streak in questions:
+            row = self.positions.get((section, number))
+            if row is not None:
+                users.setdefault(key, {})[row] = (section, number, review.ReviewState(ease, interval_days, due_at, streak))
+        return users
+
+    def _ensure_current(self):
+        version = self.store.version()
+        if self._users is None or version != self._version:
+            self._users, self._version = self._load(self.store.active_questions()), version
+
+    def _items(self, username, sections):
+        items = self._users.get(user_key(username), {})
+        if sections is None:
+            return list(items.items())
+        sections = set(sections)
+        return [(row, item) for row, item in items.items() if item[0] in sections]
+
+    def drill_rows(self, username, sections=None, rng=None, now=None):
+        """Returns every active wrong question of a user (in the given sections) as row ids in drill order.
+
+        Due questions come first, drawn with priority weights (review.drill_order); the rest
+        follow, soonest due first, so a drill is never empty while the user has wrong questions.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._ensure_current()
+            items = self._items(username, sections)
+        if not items:
+            return np.empty(0, dtype=np.int32)
+        states = [state for _, (_, _, state) in items]
+        order = review.drill_order(
+            np.fromiter((s.due_at for s in states), dtype=np.float64, count=len(states)),
+            np.fromiter((s.interval_days for s in states), dtype=np.float64, count=len(states)),
+            np.fromiter((s.ease for s in states), dtype=np.float64, count=len(states)),
+            now, rng if rng is not None else np.random.default_rng()
+        )
+        return np.fromiter((row for row, _ in items), dtype=np.int32, count=len(items))[order]
+
+    def summary(self, username, now=None):
+        """Returns (due, active) counts of a user's wrong questions."""
+        now = time.time() if now is None else now
+        with self._lock:
+            self._ensure_current()
+            states = [state for _, _, state in self._users.get(user_key(username), {}).values()]
+        return sum(s.due_at <= now for s in states), len(states)
+
+    def review(self, username, row, correct, now=None):
+        """Updates the schedule of a drilled question after an answer. Returns the new review.ReviewState, or None.
+
+        None means the question is not in the user's drill set (e.g. retired meanwhile).
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._ensure_current()
+            items = self._users.get(user_key(username), {})
+            item = items.get(row)
+            if item is None:
+                return None
+            section, number, state = item
+            new_state = state.answered(correct, now)
+            if new_state is state:
+                return state
+            self.store.review(username, section, number, new_state, now)
+            if new_state.retired:
+                del items[row]
+            else:
+                items[row] = (section, number, new_state)
+            self._version = self.store.version()
+            return new_state
+
+    def add(self, entries):
+        """Logs wrong answers through the store and reloads the affected users. Returns the count inserted."""
+        with self._lock:
+            self._ensure_current()
+            inserted = self.store.add(entries)
+            keys = {user_key(e.get("使用者", "")) for e in entries}
+            if keys:
+                # Reload from the store: a question logged again lapses, and one that had retired comes back
+                users = self._load(self.store.active_questions(keys))
+                for key in keys:
+                    self._users[key] = users.get(key, {})
+            self._version = self.store.version()
+            return inserted
+
+    def clear_user(self, username):
+        """Clears one user in the store and drops them from the index."""
+        with self._lock:
+            self._ensure_current()
+            deleted = self.store.clear_user(username)
+            self._users.pop(user_key(username), None)
+            self._version = self.store.version()
+            return deleted
+
+    def clear_all(self):
+        """Clears every user in the store and empties the index."""
+        with self._lock:
+            self.store.clear_all()
+            self._users, self._version = {}, self.store.version()
+
+
+def open_wrong_log(path):
+    """Opens the wrong-answer log backend for a path; other backends can be plugged in here by suffix."""
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix in (".db", ".sqlite", ".sqlite3"):
+        return SQLiteWrongLog(path)
+    raise ValueError(f"不支援的錯題紀錄格式：{path}")